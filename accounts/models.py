@@ -35,6 +35,9 @@ class User(AbstractUser):
     last_login_IP = models.GenericIPAddressField(verbose_name="上次登录IP", null=True, blank=True)
     source = models.CharField(verbose_name="注册来源", max_length=100, blank=True)
 
+    # 文章列表和作者页展示的名称字段
+    NAME_FIELDS = ['username', 'nickname']
+
     def get_absolute_url(self):
         return reverse('blog:author_detail', kwargs={'author_name': self.username})
 
@@ -55,6 +58,32 @@ class User(AbstractUser):
         """
         return self._meta
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 记录读取时的名称, 保存时据此判断作者的文章列表是否需要失效
+        instance._loaded_names = {field: getattr(instance, field) for field in cls.NAME_FIELDS
+                                  if field in instance.__dict__}
+        return instance
+
+    def is_name_changed(self):
+        """
+        用户名或昵称是否在读取后被修改, 新建或未从数据库读取的实例视为已修改
+        """
+        loaded_names = getattr(self, '_loaded_names', None)
+        if not loaded_names or len(loaded_names) < len(self.NAME_FIELDS):
+            return True
+        return any(getattr(self, field) != value for field, value in loaded_names.items())
+
+    def get_cache_tags(self):
+        """
+        保存后需要失效的缓存标签, 作者的文章列表按用户名查询, 只在名称改变时失效
+        """
+        tags = ['user:{pk}'.format(pk=self.pk)]
+        if self.is_name_changed():
+            tags.append('article_list')
+        return tags
+
     class Meta:
         ordering = ['-id']
         verbose_name = '用户'
@@ -131,6 +160,9 @@ class OAuthApp(models.Model):
     def __str__(self):
         return self.app_name
 
+    def get_cache_tags(self):
+        return ['oauth']
+
     class Meta:
         verbose_name = "oauth app"
         verbose_name_plural = verbose_name
@@ -157,6 +189,9 @@ class OAuthConfig(models.Model):
     def __str__(self):
         return self.oauth_app.app_name
 
+    def get_cache_tags(self):
+        return ['oauth']
+
     class Meta:
         verbose_name = "oauth 配置"
         verbose_name_plural = verbose_name
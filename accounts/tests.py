@@ -87,6 +87,32 @@ class AccountTest(TestCase):
         })
         self.assertIn(response.status_code, [301, 302, 200])
 
+    def test_login_cache_tags(self):
+        """
+        测试登录和修改用户时失效的缓存标签
+        """
+        with patch('signals.common.invalidate_tags') as invalidate_tags:
+            # 登录只更新登录时间和 IP, 不失效缓存
+            response = self.client.post(reverse('accounts:login'), {
+                'username': self.test_user.username,
+                'password': '12345678'
+            })
+            self.assertIn(response.status_code, [301, 302])
+            invalidate_tags.assert_not_called()
+
+            # 修改名称以外的字段只失效用户自身
+            user = User.objects.get(pk=self.test_user.pk)
+            user.email = 'changed@test1.com'
+            user.save()
+            invalidate_tags.assert_called_once_with('user:{pk}'.format(pk=user.pk))
+
+            # 修改昵称后作者的文章列表随之失效
+            invalidate_tags.reset_mock()
+            user = User.objects.get(pk=self.test_user.pk)
+            user.nickname = 'changed'
+            user.save()
+            invalidate_tags.assert_called_once_with('user:{pk}'.format(pk=user.pk), 'article_list')
+
     def test_verify_email_code(self):
         """
         测试发送、验证验证码逻辑
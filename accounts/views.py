@@ -111,7 +111,7 @@ class SignInView(LoginView):
             self.request.session.set_expiry(self.login_expiry)
         ip, _ = get_client_ip(self.request)
         user.last_login_IP = ip
-        user.save()
+        user.save(update_fields=['last_login_IP'])
         return super().form_valid(form)
 
 
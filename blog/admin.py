@@ -5,7 +5,7 @@ from django.contrib import admin, messages
 from django.db import models
 from django.http import HttpResponseRedirect
 from django.shortcuts import render
-from django.urls import reverse
+from django.urls import path, reverse
 from django.utils.html import format_html
 from django.utils.translation import ngettext
 from mdeditor.widgets import MDEditorWidget
@@ -13,6 +13,7 @@ from mdeditor.widgets import MDEditorWidget
 from blog.filter import ArticleListFilter
 from blog.forms import ArticleForm
 from blog.models import Article, Tag, Category, Links, ExtraSection, BlogSettings
+from utils.cache import CACHE_METRICS_SORT_FIELDS, cache_metrics, invalidate_tags
 from utils.common import send_email
 
 logger = logging.getLogger(__file__)
@@ -61,9 +62,23 @@ class ArticleAdmin(admin.ModelAdmin):
         link = reverse('admin:%s_%s_change' % info, args=(obj.category.id,))
         return format_html(u'<a href="%s">%s</a>' % (link, obj.category.name))
 
+    @staticmethod
+    def update_articles(queryset, **kwargs):
+        """
+        批量更新文章, queryset.update 不发送 post_save 信号, 需要手动失效文章列表、侧边栏和各文章的缓存
+        :param queryset: 选中的文章
+        :param kwargs: 更新的字段
+        :return: 更新的数量
+        """
+        # 先取出主键, 更新后按状态过滤的 queryset 可能不再包含这些文章
+        ids = list(queryset.values_list('id', flat=True))
+        active = Article.objects.filter(id__in=ids).update(**kwargs)
+        invalidate_tags('article_list', 'sidebar', *('article:{id}'.format(id=pk) for pk in ids))
+        return active
+
     @admin.action(description="发布选中文章")
     def make_article_publish(self, request, queryset):
-        active = queryset.update(status='publish')
+        active = self.update_articles(queryset, status='publish')
         self.message_user(
             request,
             ngettext(
@@ -76,7 +91,7 @@ class ArticleAdmin(admin.ModelAdmin):
 
     @admin.action(description="选中文章设置为草稿")
     def draft_article(self, request, queryset):
-        active = queryset.update(status='draft')
+        active = self.update_articles(queryset, status='draft')
         self.message_user(
             request,
             ngettext(
@@ -89,7 +104,7 @@ class ArticleAdmin(admin.ModelAdmin):
 
     @admin.action(description="关闭文章评论")
     def close_article_comment_status(self, request, queryset):
-        active = queryset.update(comment_status='close')
+        active = self.update_articles(queryset, comment_status='close')
         self.message_user(
             request,
             ngettext(
@@ -102,7 +117,7 @@ class ArticleAdmin(admin.ModelAdmin):
 
     @admin.action(description="打开文章评论")
     def open_article_comment_status(self, request, queryset):
-        active = queryset.update(comment_status='open')
+        active = self.update_articles(queryset, comment_status='open')
         self.message_user(
             request,
             ngettext(
@@ -211,4 +226,24 @@ class BlogSettingsAdmin(admin.ModelAdmin):
     """
     博客网站设定后台
     """
-    pass
+    def get_urls(self):
+        urls = [
+            path('cache-metrics/', self.admin_site.admin_view(self.cache_metrics_view), name='blog_cache_metrics'),
+        ]
+        return urls + super().get_urls()
+
+    def cache_metrics_view(self, request):
+        """
+        缓存统计页面, admin_view 限制只有后台用户可以访问
+        """
+        sort = request.GET.get('sort', 'misses')
+        if sort not in CACHE_METRICS_SORT_FIELDS:
+            sort = 'misses'
+        context = dict(
+            self.admin_site.each_context(request),
+            title='缓存统计',
+            rows=cache_metrics.report(sort),
+            sort_fields=CACHE_METRICS_SORT_FIELDS,
+            sort=sort,
+        )
+        return render(request, 'blog/admin_cache_metrics.html', context)
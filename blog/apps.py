@@ -5,3 +5,7 @@ class BlogConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'blog'
     verbose_name = '博客应用'
+
+    def ready(self):
+        # 注册保存模型后失效缓存、发送邮件等信号处理
+        import signals.common  # noqa
@@ -8,8 +8,9 @@ import logging
 
 from django.utils import timezone
 
-from blog.models import Category, Tag
-from utils.common import cache, get_blog_setting
+from blog.sidebar import load_category_tree, load_tag_list
+from utils.cache import get_tag_versions, get_tagged, near_cache, set_tagged
+from utils.common import get_blog_setting
 
 logger = logging.getLogger(__name__)
 
@@ -20,12 +21,23 @@ def seo_processor(requests):
     :param requests: 请求
     :return: SEO 字典
     """
-    key = 'seo_processor'
-    value = cache.get(key)
+    return near_cache.get_or_set('seo_processor', lambda: load_seo_processor(requests), ['settings', 'category', 'tag'])
+
+
+def load_seo_processor(requests):
+    """
+    从缓存加载 SEO 字典, 缓存不存在时重新生成
+    :param requests: 请求
+    :return: SEO 字典
+    """
+    # 字典的字段变化时修改版本, 部署后不会读到缺少新字段的旧缓存
+    key = 'seo_processor:v2'
+    value = get_tagged(key)
     if value:
         return value
     else:
         logger.info('set processor cache.')
+        versions = get_tag_versions(['settings', 'category', 'tag'])
         setting = get_blog_setting()
         value = {
             'SITE_NAME': setting.site_name,
@@ -36,8 +48,8 @@ def seo_processor(requests):
             'SITE_KEYWORDS': setting.site_keywords,
             'SITE_BASE_URL': requests.scheme + '://' + requests.get_host() + '/',
             'ARTICLE_SUB_LENGTH': setting.article_sub_length,
-            'category_list': Category.objects.all(),
-            'tag_list': Tag.objects.all(),
+            'category_tree': load_category_tree(),
+            'tag_list': load_tag_list(),
             'OPEN_SITE_COMMENT': setting.open_site_comment,
             'RECORD_CODE': setting.record_code,
             'ANALYTICS_CODE': setting.analytics_code,
@@ -48,5 +60,5 @@ def seo_processor(requests):
             "GLOBAL_FOOTER": setting.global_footer,
             "COMMENT_NEED_REVIEW": setting.comment_need_review,
         }
-        cache.set(key, value, 60 * 60 * 10)
+        set_tagged(key, value, versions, 60 * 60 * 10)
         return value
@@ -6,13 +6,14 @@
 # @Software: PyCharm
 from django.contrib.auth import get_user_model
 from django.contrib.syndication.views import Feed
+from django.db.models import Max
 from django.utils import timezone
 
 from blog.models import Article
-from utils.common import CommonMarkdown
+from blog.page_cache import PageCacheMixin, serve_cached_page
 
 
-class BlogFeed(Feed):
+class BlogFeed(PageCacheMixin, Feed):
     """
     博客网站 feed
     """
@@ -20,6 +21,16 @@ class BlogFeed(Feed):
     description = "自用基于Django开发的博客系统"
     link = "/feed/"
 
+    def __call__(self, request, *args, **kwargs):
+        # feed 实例在路由中共享, 不能在实例上保存请求数据, 最后修改时间单独查询
+        return serve_cached_page(request, lambda: super(BlogFeed, self).__call__(request, *args, **kwargs), self)
+
+    def get_page_cache_tags(self):
+        return ['article_list', 'settings']
+
+    def get_last_modified(self):
+        return Article.objects.filter(status='publish').aggregate(last_mod_time=Max('last_mod_time'))['last_mod_time']
+
     def author_name(self):
         return get_user_model().objects.first().nickname
 
@@ -33,7 +44,8 @@ class BlogFeed(Feed):
         return item.title
 
     def item_description(self, item):
-        return CommonMarkdown.get_markdown(item.body)
+        body, toc = item.get_rendered_body()
+        return body
 
     def item_link(self, item):
         return item.get_absolute_url()
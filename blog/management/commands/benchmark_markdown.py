@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2024/12/20 21:05
+# @Author  : Joker
+# @File    : benchmark_markdown.py
+# @Software: PyCharm
+# @Description: markdown 引擎单次调用开销基准测试
+import time
+
+from django.core.management.base import BaseCommand
+
+from utils.common import CommonMarkdown
+
+SAMPLE_COMMENT = '写得很好, 学到了 `markdown` 的用法, 参考 [文档](https://python-markdown.github.io/)'
+
+
+class Command(BaseCommand):
+    help = 'benchmark markdown engine setup cost per call'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200, help='times of each benchmark')
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        # 预热, 排除首次加载 katex 等拓展的耗时
+        CommonMarkdown.get_markdown(SAMPLE_COMMENT)
+        CommonMarkdown.get_markdown(SAMPLE_COMMENT, 'comment')
+
+        for profile in ['article', 'comment']:
+            setup_before = self.timeit(lambda: CommonMarkdown.create_engine(profile), iterations)
+            setup_after = self.timeit(lambda: CommonMarkdown.get_engine(profile).reset(), iterations)
+            convert_before = self.timeit(
+                lambda: CommonMarkdown.create_engine(profile).convert(SAMPLE_COMMENT), iterations)
+            convert_after = self.timeit(lambda: CommonMarkdown.get_markdown(SAMPLE_COMMENT, profile), iterations)
+            self.stdout.write(
+                '{profile}: setup {before:.3f}ms -> {after:.3f}ms, convert {c_before:.3f}ms -> {c_after:.3f}ms'.format(
+                    profile=profile, before=setup_before, after=setup_after,
+                    c_before=convert_before, c_after=convert_after))
+        self.stdout.write(self.style.SUCCESS('benchmark finished\n'))
+
+    @staticmethod
+    def timeit(func, iterations):
+        """
+        返回函数平均每次调用耗时(毫秒)
+        """
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        return (time.perf_counter() - start) * 1000 / iterations
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2024/12/28 20:20
+# @Author  : Joker
+# @File    : cache_metrics.py
+# @Software: PyCharm
+# @Description: 按缓存键类别查看命中率、写入大小和耗时, 找出过大或很少命中的缓存, 片段缓存另有渲染耗时和节省的耗时, 被装饰的函数另有过期命中次数
+from django.core.management.base import BaseCommand
+
+from utils.cache import CACHE_METRICS_SORT_FIELDS, cache_metrics
+
+
+class Command(BaseCommand):
+    help = 'show cache hit/miss/size/latency per key family of all workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sort', choices=CACHE_METRICS_SORT_FIELDS, default='misses', help='sort column, descending')
+        parser.add_argument('--reset', action='store_true', help='clear collected metrics')
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            cache_metrics.reset()
+            self.stdout.write(self.style.SUCCESS('cache metrics reset\n'))
+            return
+        self.stdout.write('{:<56} {:>8} {:>8} {:>6} {:>6} {:>6} {:>6} {:>10} {:>10} {:>8} {:>10} {:>10}'.format(
+            'family', 'hits', 'misses', 'rate', 'stale', 'sets', 'dels', 'avg_size', 'max_size', 'avg_ms',
+            'render_ms', 'saved_ms'))
+        for row in cache_metrics.report(options['sort']):
+            self.stdout.write('{family:<56} {hits:>8} {misses:>8} {hit_rate:>6.0%} {stale:>6} {sets:>6} {deletes:>6} '
+                              '{avg_bytes:>10} {max_bytes:>10} {avg_ms:>8.3f} {avg_render_ms:>10.3f} '
+                              '{saved_ms:>10.1f}'.format(**row))
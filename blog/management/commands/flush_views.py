@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2024/12/30 21:10
+# @Author  : Joker
+# @File    : flush_views.py
+# @Software: PyCharm
+# @Description: 把缓冲的文章浏览量写回数据库, 可由定时任务执行, 或在发布前执行
+from django.core.management.base import BaseCommand
+
+from blog.view_counter import VIEW_COUNTER_KEY, view_counter
+from utils.cache import cache
+
+
+class Command(BaseCommand):
+    help = 'flush buffered article views to the database'
+
+    def handle(self, *args, **options):
+        # 与请求中的后台写回共用一把锁
+        lock_key = VIEW_COUNTER_KEY + ':refresh'
+        if not cache.add(lock_key, 1, 60):
+            self.stdout.write('another flush is running, skipped')
+            return
+        try:
+            count = view_counter.flush()
+        finally:
+            cache.delete(lock_key)
+        self.stdout.write(self.style.SUCCESS('flushed views of {count} articles\n'.format(count=count)))
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2024/12/23 21:30
+# @Author  : Joker
+# @File    : prerender_articles.py
+# @Software: PyCharm
+# @Description: 多进程批量预渲染文章, 部署或修改 markdown 拓展后预热渲染结果
+import argparse
+import datetime
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from blog.models import Article
+from utils.cache import invalidate_tags
+from utils.common import CommonMarkdown
+
+
+def parse_since(value):
+    """
+    解析 --since 参数, 支持日期和日期时间
+    """
+    since = parse_datetime(value)
+    if since is None:
+        day = parse_date(value)
+        if day is None:
+            raise argparse.ArgumentTypeError('invalid date: %s' % value)
+        since = datetime.datetime.combine(day, datetime.time.min)
+    if settings.USE_TZ and timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+def init_worker():
+    """
+    子进程初始化, spawn 方式启动的子进程需要重新加载 django
+    """
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+
+def render_chunk(chunk):
+    """
+    渲染一批文章, 在子进程中执行, 不访问数据库
+    :param chunk: [(id, 正文), ...]
+    :return: [(id, {渲染字段: 值}), ...]
+    """
+    results = []
+    for pk, body in chunk:
+        article = Article(pk=pk, body=body)
+        article.render_body()
+        results.append((pk, {field: getattr(article, field) for field in Article.RENDER_FIELDS}))
+    return results
+
+
+class Command(BaseCommand):
+    help = 'prerender markdown of published articles in parallel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=parse_since, default=None,
+                            help='only articles modified since this date, e.g. 2024-12-01')
+        parser.add_argument('--chunk-size', type=int, default=50, help='articles per task and per database write')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='worker processes, 1 renders in the current process')
+        parser.add_argument('--force', action='store_true', help='rerender articles whose body and render version are unchanged')
+
+    def get_chunks(self, since, chunk_size, force):
+        """
+        按批读取需要渲染的文章, 先取出 id 再逐批查询正文, 不会一次把所有正文读入内存
+        """
+        articles = Article.objects.filter(status='publish').order_by('id')
+        if since is not None:
+            articles = articles.filter(last_mod_time__gte=since)
+        ids = list(articles.values_list('id', flat=True))
+        for start in range(0, len(ids), chunk_size):
+            batch = articles.filter(id__in=ids[start:start + chunk_size]).values_list('id', 'body', 'body_hash')
+            chunk = [(pk, body) for pk, body, body_hash in batch
+                     if force or body_hash != CommonMarkdown.get_render_hash(body)]
+            if chunk:
+                yield chunk
+
+    def render_in_pool(self, chunks, workers):
+        """
+        多进程渲染, 最多同时提交 workers * 2 批, 按提交顺序返回结果
+        """
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(render_chunk, chunk))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def handle(self, *args, **options):
+        chunk_size = max(options['chunk_size'], 1)
+        workers = max(options['workers'], 1)
+        chunks = self.get_chunks(options['since'], chunk_size, options['force'])
+        start = time.perf_counter()
+
+        if workers == 1:
+            total = self.save_results(map(render_chunk, chunks))
+        else:
+            total = self.save_results(self.render_in_pool(chunks, workers))
+
+        self.stdout.write(self.style.SUCCESS('prerendered {total} articles in {cost:.2f}s\n'.format(
+            total=total, cost=time.perf_counter() - start)))
+
+    def save_results(self, results):
+        """
+        按批写回数据库, bulk_update 不触发信号, 也不会改动修改时间, 每批写回后失效文章和列表的缓存
+        :return: 写回的文章数
+        """
+        total = 0
+        for chunk in results:
+            articles = [Article(pk=pk, **fields) for pk, fields in chunk]
+            Article.objects.bulk_update(articles, Article.RENDER_FIELDS)
+            invalidate_tags('article_list', *['article:{id}'.format(id=article.pk) for article in articles])
+            total += len(articles)
+            self.stdout.write('saved {count} articles'.format(count=len(articles)))
+        return total
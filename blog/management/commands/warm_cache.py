@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2024/12/27 21:00
+# @Author  : Joker
+# @File    : warm_cache.py
+# @Software: PyCharm
+# @Description: 按站点地图预热页面缓存, 部署、清理缓存或修改网站配置后执行
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import Client
+
+from blog.page_cache import WARM_CACHE_HEADER, get_warm_token
+from blog.sidebar import get_hot_articles
+from blog.urls import sitemaps
+from utils.common import get_current_site
+
+
+class Command(BaseCommand):
+    help = 'warm page caches by rendering sitemap urls in a thread pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4, help='threads rendering pages, 1 renders in the current thread')
+        parser.add_argument('--sections', nargs='+', choices=list(sitemaps), default=list(sitemaps),
+                            help='sitemap sections to warm, all by default')
+        parser.add_argument('--no-hot-first', action='store_true',
+                            help='do not warm the home page and hot articles before other pages')
+        parser.add_argument('--limit', type=int, default=None, help='warm at most this many urls')
+        parser.add_argument('--secure', action=argparse.BooleanOptionalAction, default=True,
+                            help='request pages over https so canonical and og:url links use https, on by default')
+
+    def get_urls(self, sections, hot_first):
+        """
+        站点地图中的 url, 按优先级从高到低排列, 首页和热门文章排在最前
+        """
+        urls = []
+        for name in sections:
+            site_map = sitemaps[name]()
+            priority = float(site_map.priority or 0.5)
+            for item in site_map.items():
+                urls.append((priority, site_map.location(item)))
+        urls.sort(key=lambda url: -url[0])
+        urls = [url for priority, url in urls]
+        if hot_first:
+            first = ['/'] + [article.url for article in get_hot_articles()]
+            urls = first + [url for url in urls if url not in first]
+        return list(dict.fromkeys(urls))
+
+    def handle(self, *args, **options):
+        urls = self.get_urls(options['sections'], not options['no_hot_first'])
+        if options['limit'] is not None:
+            urls = urls[:options['limit']]
+        host = get_current_site().domain
+        secure = options['secure']
+        headers = {WARM_CACHE_HEADER: get_warm_token()}
+        local = threading.local()
+
+        def warm(url):
+            # Client 不是线程安全的, 每个线程使用自己的 Client
+            if not hasattr(local, 'client'):
+                local.client = Client(HTTP_HOST=host, raise_request_exception=False)
+            start = time.perf_counter()
+            response = local.client.get(url, secure=secure, **headers)
+            return url, response.status_code, (time.perf_counter() - start) * 1000
+
+        def warm_in_thread(url):
+            try:
+                return warm(url)
+            finally:
+                # 线程池中的数据库连接不会随请求结束关闭
+                connections.close_all()
+
+        concurrency = max(options['concurrency'], 1)
+        start = time.perf_counter()
+        if concurrency == 1:
+            results = list(map(warm, urls))
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = list(executor.map(warm_in_thread, urls))
+        total = time.perf_counter() - start
+
+        failed = [(url, status) for url, status, cost in results if status != 200]
+        for url, status in failed:
+            self.stderr.write('{status} {url}'.format(status=status, url=url))
+        costs = sorted(cost for url, status, cost in results)
+        if costs:
+            self.stdout.write('avg {avg:.1f}ms, p50 {p50:.1f}ms, p95 {p95:.1f}ms, max {max:.1f}ms'.format(
+                avg=sum(costs) / len(costs), p50=costs[len(costs) // 2],
+                p95=costs[min(int(len(costs) * 0.95), len(costs) - 1)], max=costs[-1]))
+            for url, status, cost in sorted(results, key=lambda result: -result[2])[:5]:
+                self.stdout.write('  {cost:.1f}ms {url}'.format(cost=cost, url=url))
+        self.stdout.write(self.style.SUCCESS('warmed {count} urls, {failed} failed in {total:.2f}s\n'.format(
+            count=len(results), failed=len(failed), total=total)))
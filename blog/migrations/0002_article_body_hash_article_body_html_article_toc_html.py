@@ -0,0 +1,28 @@
+# Generated by Django 5.0.14 on 2026-10-19 03:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='body_hash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64, verbose_name='正文哈希'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='body_html',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='渲染后的正文'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='toc_html',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='渲染后的目录'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.0.14 on 2026-10-19 04:05
+
+from django.db import migrations, models
+
+
+def expire_article_renders(apps, schema_editor):
+    # 清空正文哈希, 已有文章在下次读取或执行 prerender_articles 时补齐摘要和阅读信息
+    Article = apps.get_model('blog', 'Article')
+    Article.objects.update(body_hash='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0002_article_body_hash_article_body_html_article_toc_html'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='char_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='字符数'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='excerpt',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='摘要'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='reading_time',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='阅读时间(分钟)'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='word_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='字数'),
+        ),
+        migrations.RunPython(expire_article_renders, migrations.RunPython.noop),
+    ]
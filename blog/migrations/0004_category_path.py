@@ -0,0 +1,33 @@
+# Generated by Django 5.0.14 on 2026-10-19 21:10
+
+from django.db import migrations, models
+
+
+def build_category_paths(apps, schema_editor):
+    # 从根分类开始逐层生成已有分类的路径
+    Category = apps.get_model('blog', 'Category')
+    children = {}
+    for category in Category.objects.all():
+        children.setdefault(category.parent_category_id, []).append(category)
+    stack = [(category, '/') for category in children.get(None, [])]
+    while stack:
+        category, parent_path = stack.pop()
+        category.path = '{parent}{id}/'.format(parent=parent_path, id=category.pk)
+        stack.extend((child, category.path) for child in children.get(category.pk, []))
+        Category.objects.filter(pk=category.pk).update(path=category.path)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0003_article_reading_meta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255, verbose_name='路径'),
+        ),
+        migrations.RunPython(build_category_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.0.14 on 2026-10-19 05:04
+
+from django.db import migrations, models
+
+
+def expire_article_renders(apps, schema_editor):
+    # 清空正文哈希, 已有文章在下次读取或执行 prerender_articles 时重新判断是否需要加载 KaTeX 脚本
+    Article = apps.get_model('blog', 'Article')
+    Article.objects.update(body_hash='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0004_category_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='has_client_math',
+            field=models.BooleanField(default=False, editable=False, verbose_name='包含客户端渲染的公式'),
+        ),
+        migrations.RunPython(expire_article_renders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.14 on 2026-10-19 05:11
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0005_article_has_client_math'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['article_order', 'created_time', 'id'], name='blog_article_keyset_idx'),
+        ),
+    ]
@@ -1,19 +1,28 @@
 import logging
 from abc import abstractmethod
+from collections import namedtuple
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
 from django.urls import reverse
+from django.utils.safestring import mark_safe
 from django.utils.translation import gettext_lazy as _
 from mdeditor.fields import MDTextField
 from uuslug import slugify
 
-from utils.common import cache, get_current_site, cache_decorator
+from blog.view_counter import view_counter
+from utils.cache import get_tag_versions, get_tagged, set_tagged, invalidate_tags
+from utils.common import get_current_site, cache_decorator, get_text_meta, has_client_math, CommonMarkdown
 
 logger = logging.getLogger(__name__)
 
+# 文章渲染结果: 正文 html, 目录 html, 纯文本摘要
+ArticleRender = namedtuple('ArticleRender', ['body', 'toc', 'excerpt', 'has_client_math'])
+
 
 # Create your models here.
 class LinkShowType(models.TextChoices):
@@ -46,6 +55,13 @@ class BaseModel(models.Model):
         url = "https://{site}{path}".format(site=site, path=self.get_absolute_url())
         return url
 
+    def get_cache_tags(self):
+        """
+        保存后需要失效的缓存标签, 子类按依赖关系补充
+        :return: 标签列表
+        """
+        return ['{name}:{pk}'.format(name=self._meta.model_name, pk=self.pk)]
+
     class Meta:
         abstract = True
 
@@ -64,6 +80,18 @@ def author_directory_path(instance, filename: str) -> str:
     return 'uploads/' + str(instance.author.id) + f'/{filename}'
 
 
+class ArticleQuerySet(models.QuerySet):
+    # 文章卡片不显示的大字段
+    CARD_DEFERRED_FIELDS = ['body', 'body_html', 'toc_html']
+
+    def cards(self):
+        """
+        列表页文章卡片, 不查询正文, 一并查询分类和作者, 预取标签, 查询次数与文章数量无关
+        :return: 文章查询集
+        """
+        return self.select_related('category', 'author').prefetch_related('tags').defer(*self.CARD_DEFERRED_FIELDS)
+
+
 class Article(BaseModel):
     """文章"""
     STATUS_CHOICES = (
@@ -92,6 +120,21 @@ class Article(BaseModel):
     status = models.CharField('文章状态', max_length=20, choices=STATUS_CHOICES, default='draft')
     comment_status = models.CharField('评论状态', max_length=20, choices=COMMENT_STATUS, default='open')
     type = models.CharField('类型', max_length=20, choices=TYPE, default='article')
+    body_html = models.TextField('渲染后的正文', blank=True, default='', editable=False)
+    toc_html = models.TextField('渲染后的目录', blank=True, default='', editable=False)
+    body_hash = models.CharField('正文哈希', max_length=64, blank=True, default='', editable=False)
+    excerpt = models.TextField('摘要', blank=True, default='', editable=False)
+    word_count = models.PositiveIntegerField('字数', default=0, editable=False)
+    char_count = models.PositiveIntegerField('字符数', default=0, editable=False)
+    reading_time = models.PositiveIntegerField('阅读时间(分钟)', default=0, editable=False)
+    has_client_math = models.BooleanField('包含客户端渲染的公式', default=False, editable=False)
+
+    objects = ArticleQuerySet.as_manager()
+
+    # 渲染正文时一并计算并保存的字段
+    RENDER_FIELDS = ['body_html', 'toc_html', 'body_hash', 'excerpt', 'word_count', 'char_count', 'reading_time',
+                     'has_client_math']
+    EXCERPT_LENGTH = 120
 
     def __str__(self):
         return self.title
@@ -101,6 +144,10 @@ class Article(BaseModel):
         verbose_name = "文章"
         verbose_name_plural = verbose_name
         get_latest_by = 'id'
+        # 键集分页按 (article_order, created_time, id) 排序和定位
+        indexes = [
+            models.Index(fields=['article_order', 'created_time', 'id'], name='blog_article_keyset_idx'),
+        ]
 
     def get_meta_data(self):
         return self._meta
@@ -110,29 +157,77 @@ class Article(BaseModel):
             'slug': self.slug
         })
 
-    @cache_decorator(60 * 60 * 10)
+    def get_cache_tags(self):
+        return super().get_cache_tags() + ['article_list', 'sidebar']
+
+    @cache_decorator(60 * 60 * 10, tags=lambda self: ['category', 'article:{id}'.format(id=self.id)])
     def get_category_tree(self):
         tree = self.category.get_category_tree()
         names = list(map(lambda c: (c.name, c.get_absolute_url()), tree))
 
         return names
 
+    def is_render_stale(self):
+        """
+        正文或渲染版本是否在上次渲染后被修改
+        """
+        return self.body_hash != CommonMarkdown.get_render_hash(self.body)
+
+    def render_body(self):
+        """
+        渲染 markdown 正文, 将 html、目录、正文哈希以及摘要、字数、阅读时间和是否需要客户端公式渲染保存到实例上,
+        只重新渲染改动过的块
+        """
+        self.body_html, self.toc_html = CommonMarkdown.get_markdown_incremental(self.body)
+        self.body_hash = CommonMarkdown.get_render_hash(self.body)
+        self.excerpt, self.word_count, self.char_count, self.reading_time = get_text_meta(
+            self.body_html, self.EXCERPT_LENGTH)
+        self.has_client_math = has_client_math(self.body_html)
+
+    def get_rendered_body(self):
+        """
+        获取渲染后的正文和目录, 仅在哈希过期时重新渲染并写回数据库
+        :return: (正文 html, 目录 html)
+        """
+        if self.is_render_stale():
+            self.render_body()
+            if self.pk:
+                Article.objects.filter(pk=self.pk).update(
+                    **{field: getattr(self, field) for field in self.RENDER_FIELDS})
+        return self.body_html, self.toc_html
+
+    def get_render(self):
+        """
+        获取文章的完整渲染结果, 摘要为未转义的纯文本, 只在模板输出时转义一次
+        :return: ArticleRender
+        """
+        body, toc = self.get_rendered_body()
+        return ArticleRender(mark_safe(body), mark_safe(toc), self.excerpt, self.has_client_math)
+
     def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if self.is_render_stale() and (update_fields is None or 'body' in update_fields):
+            self.render_body()
+            if update_fields is not None:
+                kwargs['update_fields'] = list(update_fields) + self.RENDER_FIELDS
         super().save(*args, **kwargs)
 
     def viewed(self):
-        self.views += 1
-        self.save(update_fields=['views'])
+        """
+        浏览量加一, 只累加到计数缓冲中, 由 view_counter 定期写回数据库
+        """
+        self.views += view_counter.incr(self.pk)
 
     def comment_list(self):
         cache_key = 'article_comments_{id}'.format(id=self.id)
-        value = cache.get(cache_key)
+        value = get_tagged(cache_key)
         if value:
             logger.info('get article comments:{id}'.format(id=self.id))
             return value
         else:
+            versions = get_tag_versions(['article:{id}'.format(id=self.id)])
             comments = self.comment_set.filter(is_enable=True).order_by('-id')
-            cache.set(cache_key, comments, 60 * 100)
+            set_tagged(cache_key, comments, versions, 60 * 100)
             logger.info('set article comments:{id}'.format(id=self.id))
             return comments
 
@@ -140,12 +235,12 @@ class Article(BaseModel):
         info = (self._meta.app_label, self._meta.model_name)
         return reverse('admin:%s_%s_change' % info, args=(self.pk,))
 
-    @cache_decorator(expiration=60 * 100)
+    @cache_decorator(expiration=60 * 100, tags=['article_list'])
     def next_article(self):
         # 下一篇
         return Article.objects.filter(id__gt=self.id, status='publish').order_by('id').first()
 
-    @cache_decorator(expiration=60 * 100)
+    @cache_decorator(expiration=60 * 100, tags=['article_list'])
     def previous_article(self):
         # 前一篇
         return Article.objects.filter(id__lt=self.id, status='publish').first()
@@ -159,6 +254,8 @@ class Category(BaseModel):
                                         on_delete=models.CASCADE)
     slug = models.SlugField('处理后的标题', default='no-slug', max_length=60, blank=True)
     index = models.IntegerField(default=0, verbose_name="权重排序-越大越靠前")
+    # 物化路径, 从根分类到自身的 id, 如 /1/4/9/, 保存时维护
+    path = models.CharField('路径', max_length=255, default='', db_index=True, editable=False)
 
     class Meta:
         ordering = ['-index']
@@ -173,42 +270,77 @@ class Category(BaseModel):
     def __str__(self):
         return self.name
 
-    @cache_decorator(60 * 60 * 10)
-    def get_category_tree(self):
+    def get_cache_tags(self):
+        return super().get_cache_tags() + ['category', 'article_list']
+
+    def build_path(self):
         """
-        递归获得分类目录的父级
-        :return:
+        根据父级分类的路径生成自身的路径
+        :return: 路径
+        """
+        parent_path = '/'
+        if self.parent_category_id:
+            parent_path = Category.objects.values_list('path', flat=True).get(pk=self.parent_category_id)
+        return '{parent}{id}/'.format(parent=parent_path, id=self.pk)
+
+    def clean(self):
+        if self.pk and self.parent_category_id and (self.parent_category_id == self.pk or (
+                self.path and self.parent_category.path.startswith(self.path))):
+            raise ValidationError(_('父级分类不能是自身或子分类'))
+
+    def save(self, *args, **kwargs):
+        if self.pk is None:
+            # 新建分类保存后才有 id, 没有子分类
+            super().save(*args, **kwargs)
+            self.path = self.build_path()
+            Category.objects.filter(pk=self.pk).update(path=self.path)
+            return
+        old_path, self.path = self.path, self.build_path()
+        if self.path != old_path:
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = list(kwargs['update_fields']) + ['path']
+            if old_path:
+                # 调整层级时一条 UPDATE 替换所有子分类的路径前缀
+                Category.objects.filter(path__startswith=old_path).exclude(pk=self.pk).update(
+                    path=Concat(Value(self.path), Substr('path', len(old_path) + 1)))
+        super().save(*args, **kwargs)
+
+    def get_path_ids(self):
+        """
+        路径中的分类 id, 从根分类到自身
+        """
+        return [int(pk) for pk in self.path.strip('/').split('/') if pk]
+
+    def get_ancestors(self):
         """
-        category_list = []
+        自身和所有父级分类, 一次查询
+        :return: 查询集
+        """
+        return Category.objects.filter(pk__in=self.get_path_ids())
 
-        def parse(category):
-            category_list.append(category)
-            if category.parent_category:
-                parse(category.parent_category)
+    def get_descendants(self):
+        """
+        自身和所有子分类, 一次按路径前缀的索引查询, 可作为子查询使用
+        :return: 查询集
+        """
+        return Category.objects.filter(path__startswith=self.path)
 
-        parse(self)
-        return category_list
+    @cache_decorator(60 * 60 * 10, tags=['category'])
+    def get_category_tree(self):
+        """
+        获得分类目录的父级, 从自身到根分类
+        :return:
+        """
+        categories = self.get_ancestors().in_bulk()
+        return [categories[pk] for pk in reversed(self.get_path_ids()) if pk in categories]
 
-    @cache_decorator(60 * 60 * 10)
+    @cache_decorator(60 * 60 * 10, tags=['category'])
     def get_sub_category(self):
         """
         获得当前分类目录所有子集
         :return:
         """
-        category_list = []
-        all_category_list = Category.objects.all()
-
-        def parse(category):
-            if category not in category_list:
-                category_list.append(category)
-            child_list = all_category_list.filter(parent_category=category)
-            for child in child_list:
-                if category not in category_list:
-                    category_list.append(child)
-                parse(child)
-
-        parse(self)
-        return category_list
+        return list(self.get_descendants())
 
     def get_meta_data(self):
         return self._meta
@@ -226,7 +358,10 @@ class Tag(BaseModel):
     def get_absolute_url(self):
         return reverse('blog:tag_detail', kwargs={'tag_name': self.slug})
 
-    @cache_decorator(60 * 60 * 10)
+    def get_cache_tags(self):
+        return super().get_cache_tags() + ['tag', 'article_list']
+
+    @cache_decorator(60 * 60 * 10, tags=['article_list'])
     def get_article_count(self):
         return Article.objects.filter(tags__name=self.name).distinct().count()
 
@@ -275,6 +410,9 @@ class Links(models.Model):
     def get_meta_data(self):
         return self._meta
 
+    def get_cache_tags(self):
+        return ['sidebar']
+
 
 class ExtraSection(models.Model):
     """额外区域, 首页处了固定内容可添加额外内容"""
@@ -293,6 +431,9 @@ class ExtraSection(models.Model):
     def __str__(self):
         return self.name
 
+    def get_cache_tags(self):
+        return ['sidebar']
+
 
 class BlogSettings(models.Model):
     """blog的配置"""
@@ -362,5 +503,4 @@ class BlogSettings(models.Model):
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
-        from utils.common import cache
-        cache.clear()
+        invalidate_tags('settings', 'sidebar')
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2024/12/26 20:30
+# @Author  : Joker
+# @File    : page_cache.py
+# @Software: PyCharm
+# @Description: 匿名用户整页缓存, 缓存命中时不渲染模板, 并根据 ETag / Last-Modified 返回 304
+import logging
+from collections import namedtuple
+
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import http_date, quote_etag
+
+from utils.cache import get_tag_versions, get_tagged, reset_stale_served, set_tagged, was_stale_served
+from utils.common import get_sha256
+
+logger = logging.getLogger(__name__)
+
+PageEntry = namedtuple('PageEntry', ['content', 'content_type', 'etag', 'last_modified', 'extra'])
+
+PAGE_CACHE_TIMEOUT = 60 * 60
+
+# 预热缓存的请求头, 值为 get_warm_token(), 带有该请求头的请求不计入浏览量
+WARM_CACHE_HEADER = 'HTTP_X_CACHE_WARM'
+
+
+def is_page_cacheable(request):
+    """
+    只缓存匿名用户的 GET / HEAD 请求, 登录用户的页面包含个人信息和带 csrf token 的评论表单
+    匿名用户的页面不渲染评论表单, 不会调用 get_token, 缓存的页面中没有某个访客的 csrf token
+    """
+    return request.method in ('GET', 'HEAD') and not request.user.is_authenticated
+
+
+def get_warm_token():
+    """
+    预热请求头的值, 由 SECRET_KEY 生成, 外部请求无法伪造
+    """
+    return salted_hmac('blog.page_cache.warm', 'warm_cache').hexdigest()
+
+
+def is_warm_request(request):
+    value = request.META.get(WARM_CACHE_HEADER)
+    return value is not None and constant_time_compare(value, get_warm_token())
+
+
+def get_page_cache_key(request):
+    # 页面中的绝对地址由 build_absolute_uri 生成, http 和 https 分开缓存
+    return 'page_cache:' + get_sha256(request.build_absolute_uri())
+
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+
+
+def serve_cached_page(request, render, view, timeout=PAGE_CACHE_TIMEOUT):
+    """
+    从整页缓存返回响应, 未命中时渲染并按标签缓存
+    :param request: 请求
+    :param render: 渲染函数, 返回响应
+    :param view: 提供 get_page_cache_tags、get_last_modified、get_page_cache_extra 和 page_cache_hit 的视图
+    :param timeout: 过期时间
+    :return: 响应
+    """
+    if not is_page_cacheable(request):
+        return render()
+    key = get_page_cache_key(request)
+    entry = get_tagged(key)
+    if entry is not None:
+        logger.debug('page cache hit:{path}'.format(path=request.path))
+        view.page_cache_hit(request, entry.extra)
+        response = HttpResponse(entry.content, content_type=entry.content_type)
+        set_validators(response, entry.etag, entry.last_modified)
+        return get_conditional_response(request, etag=entry.etag, last_modified=entry.last_modified,
+                                        response=response)
+
+    # 渲染前读取标签版本号, 渲染期间发生的失效不会被记到新版本下; feed 实例在请求间共享, 版本号保存在请求上
+    versions = request.page_cache_versions = get_tag_versions(view.get_page_cache_tags())
+    reset_stale_served()
+    response = render()
+    if response.status_code != 200 or response.streaming:
+        return response
+    if hasattr(response, 'render'):
+        response.render()
+    if request.META.get('CSRF_COOKIE_NEEDS_UPDATE'):
+        # 页面中含有当前访客的 csrf token, 不能共享给其他访客
+        return response
+    if was_stale_served():
+        # 侧边栏等数据返回了旧值并在后台刷新, 不缓存这样的页面, 刷新完成后的请求再缓存
+        return response
+    last_modified = view.get_last_modified()
+    last_modified = int(last_modified.timestamp()) if last_modified else None
+    etag = quote_etag(get_sha256(response.content.decode(response.charset)))
+    set_tagged(key, PageEntry(response.content, response['Content-Type'], etag, last_modified,
+                              view.get_page_cache_extra()), versions, timeout)
+    set_validators(response, etag, last_modified)
+    return get_conditional_response(request, etag=etag, last_modified=last_modified, response=response)
+
+
+class PageCacheMixin:
+    """
+    视图整页缓存, 子类提供缓存标签和最后修改时间
+    """
+    page_cache_timeout = PAGE_CACHE_TIMEOUT
+
+    def get_page_cache_tags(self):
+        """
+        子类重写.页面依赖的缓存标签, 渲染前调用, 导航栏的分类、标签和网站配置所有页面都依赖
+        """
+        return ['category', 'tag', 'settings']
+
+    def add_page_cache_tags(self, *tags):
+        """
+        渲染中才能确定的标签, 如详情页的文章, 应在查询到对象后、读取其他数据之前调用
+        """
+        versions = getattr(self.request, 'page_cache_versions', None)
+        if versions is not None:
+            versions.update(get_tag_versions(tags))
+
+    def get_last_modified(self):
+        """
+        子类可重写.页面内容的最后修改时间, 渲染后调用
+        """
+        return None
+
+    def get_page_cache_extra(self):
+        """
+        子类可重写.命中缓存时需要的额外数据
+        """
+        return None
+
+    def page_cache_hit(self, request, extra):
+        """
+        子类可重写.命中缓存时调用
+        """
+        pass
+
+    def dispatch(self, request, *args, **kwargs):
+        return serve_cached_page(request, lambda: super(PageCacheMixin, self).dispatch(request, *args, **kwargs),
+                                 self, self.page_cache_timeout)
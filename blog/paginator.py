@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2024/12/31 20:30
+# @Author  : Joker
+# @File    : paginator.py
+# @Software: PyCharm
+# @Description: 键集分页, 按排序字段定位下一页, 不使用 COUNT(*) 和深度 OFFSET, 页码与游标的对应关系缓存在带标签的缓存中
+import base64
+import binascii
+import json
+import math
+
+from django.core.paginator import EmptyPage, PageNotAnInteger
+from django.db.models import Q
+
+from utils.cache import get_tag_versions, get_tagged, set_tagged
+from utils.common import get_sha256
+
+# 文章列表的键集排序, 最后以 id 保证顺序唯一
+ARTICLE_KEYSET_ORDERING = ('-article_order', '-created_time', '-id')
+# 近似总数的缓存时间, 过期或标签失效后重新 COUNT 一次
+APPROXIMATE_COUNT_TIMEOUT = 60 * 60
+
+
+class KeysetPage:
+    """
+    键集分页的一页, 提供模板需要的 Page 接口
+    """
+
+    def __init__(self, object_list, number, paginator, has_next, next_cursor):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_next = has_next
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self.number > 1
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def next_page_number(self):
+        if not self._has_next:
+            raise EmptyPage('That page contains no results')
+        return self.number + 1
+
+    def previous_page_number(self):
+        if self.number <= 1:
+            raise EmptyPage('That page number is less than 1')
+        return self.number - 1
+
+
+class KeysetPaginator:
+    """
+    键集分页器, 游标为上一页最后一行排序字段的值, 编码为不透明的字符串, 下一页链接带上游标直接定位
+    页码链接仍然可用, 各页起始游标按列表缓存, 标签失效后从最近的已知页一次查询补齐
+    """
+
+    def __init__(self, queryset, per_page, ordering=ARTICLE_KEYSET_ORDERING, cache_tags=('article_list',)):
+        self.ordering = tuple(ordering)
+        self.fields = [name.lstrip('-') for name in self.ordering]
+        self.queryset = queryset.order_by(*self.ordering)
+        self.per_page = int(per_page)
+        self.cache_tags = list(cache_tags)
+        self.cache_key = 'keyset:' + get_sha256(str(self.queryset.query))
+        self.count_key = self.cache_key + ':count'
+
+    def encode_cursor(self, values):
+        # 时间保留微秒, 否则定位时相等比较会失败
+        data = json.dumps(list(values), default=lambda value: value.isoformat()).encode('utf-8')
+        return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        except (ValueError, binascii.Error):
+            raise PageNotAnInteger('Invalid cursor')
+        if not isinstance(values, list) or len(values) != len(self.fields):
+            raise PageNotAnInteger('Invalid cursor')
+        model = self.queryset.model
+        return [model._meta.get_field(name).to_python(value) for name, value in zip(self.fields, values)]
+
+    def seek(self, cursor):
+        """
+        游标之后的行, (a, b, c) < (x, y, z) 展开为 a < x or (a = x and b < y) or ...
+        :param cursor: 游标, None 表示第一页
+        :return: 查询集
+        """
+        if cursor is None:
+            return self.queryset
+        values = self.decode_cursor(cursor)
+        condition = Q()
+        for i, name in enumerate(self.ordering):
+            field = self.fields[i]
+            lookup = '{field}__{op}'.format(field=field, op='lt' if name.startswith('-') else 'gt')
+            condition |= Q(**dict(zip(self.fields[:i], values[:i])), **{lookup: values[i]})
+        return self.queryset.filter(condition)
+
+    def get_cursor(self, boundaries, number):
+        """
+        第 number 页的起始游标, 从最近的已知页开始一次查询之后各行的排序字段, 每页最后一行即下一页的游标,
+        补齐的游标写入 boundaries
+        :param boundaries: {页码: 起始游标}, 页码从 1 开始连续
+        :param number: 页码
+        :return: 游标
+        """
+        known = min(number, len(boundaries))
+        if known < number:
+            rows = list(self.seek(boundaries[known]).values_list(*self.fields)[:(number - known) * self.per_page])
+            for page, row in enumerate(rows[self.per_page - 1::self.per_page], known + 1):
+                boundaries[page] = self.encode_cursor(row)
+            if number not in boundaries:
+                raise EmptyPage('That page contains no results')
+        return boundaries[number]
+
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        return number
+
+    def get_rows(self, cursor, number):
+        """
+        游标之后的一页, 多取一行判断是否有下一页
+        :return: (当前页的行, 是否有下一页)
+        """
+        rows = list(self.seek(cursor)[:self.per_page + 1])
+        if not rows and number > 1:
+            raise EmptyPage('That page contains no results')
+        return rows[:self.per_page], len(rows) > self.per_page
+
+    def get_next_cursor(self, rows):
+        return self.encode_cursor(getattr(rows[-1], field) for field in self.fields)
+
+    def page(self, number, cursor=None):
+        """
+        查询一页
+        带游标时直接从游标定位, 游标来自请求, 不写入页码与游标的对应关系, 也不修正近似总数
+        超出近似总页数的页码直接拒绝, 补齐的游标即使最终没有这一页也会保存, 不会每次重新查询
+        :param number: 页码
+        :param cursor: 本页的起始游标, 即上一页链接中的游标
+        :return: KeysetPage
+        """
+        number = self.validate_number(number)
+        if cursor is not None:
+            rows, has_next = self.get_rows(cursor, number)
+            return KeysetPage(rows, number, self, has_next, self.get_next_cursor(rows) if has_next else None)
+        versions = get_tag_versions(self.cache_tags)
+        boundaries = get_tagged(self.cache_key) or {1: None}
+        known = len(boundaries)
+        if number > known and number > self.num_pages + 1:
+            raise EmptyPage('That page contains no results')
+        try:
+            rows, has_next = self.get_rows(self.get_cursor(boundaries, number), number)
+            next_cursor = boundaries.setdefault(number + 1, self.get_next_cursor(rows)) if has_next else None
+        finally:
+            if len(boundaries) != known:
+                set_tagged(self.cache_key, boundaries, versions)
+        self.update_count(number, len(rows), has_next, versions)
+        return KeysetPage(rows, number, self, has_next, next_cursor)
+
+    def update_count(self, number, size, has_next, versions):
+        """
+        用当前页修正近似总数, 到达最后一页时即为准确值
+        :param versions: 查询前读取的标签版本
+        """
+        count = (number - 1) * self.per_page + size
+        if not has_next:
+            set_tagged(self.count_key, count, versions, APPROXIMATE_COUNT_TIMEOUT)
+        elif self.count <= count:
+            set_tagged(self.count_key, count + 1, versions, APPROXIMATE_COUNT_TIMEOUT)
+
+    @property
+    def count(self):
+        """
+        近似总数, 与游标使用相同的标签, 文章发布或删除后重新 COUNT 一次, 期间由访问到的页修正
+        """
+        count = get_tagged(self.count_key)
+        if count is None:
+            versions = get_tag_versions(self.cache_tags)
+            count = self.queryset.count()
+            set_tagged(self.count_key, count, versions, APPROXIMATE_COUNT_TIMEOUT)
+        return count
+
+    @property
+    def num_pages(self):
+        return max(math.ceil(self.count / self.per_page), 1)
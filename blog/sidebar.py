@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2024/12/25 20:10
+# @Author  : Joker
+# @File    : sidebar.py
+# @Software: PyCharm
+# @Description: 侧边栏数据, 缓存查询完成后的不可变数据, 命中缓存时渲染不再访问数据库
+import time
+from collections import namedtuple
+
+from django.db.models import Q
+
+from blog.models import Article, Category, ExtraSection, Links, LinkShowType, Tag
+from blog.view_counter import view_counter
+from comments.models import Comment
+from utils.cache import get_tag_versions, get_tagged_stale, mark_stale_served, refresh_in_background, set_tagged
+from utils.common import get_blog_setting, CommonMarkdown
+
+SidebarCategory = namedtuple('SidebarCategory', ['name', 'icon', 'url', 'children'])
+SidebarArticle = namedtuple('SidebarArticle', ['title', 'slug', 'url', 'cover_url', 'category_name', 'category_url',
+                                               'views'])
+SidebarComment = namedtuple('SidebarComment', ['pk', 'body', 'article'])
+SidebarLink = namedtuple('SidebarLink', ['name', 'link', 'notice'])
+SidebarSection = namedtuple('SidebarSection', ['name', 'content_html'])
+SidebarTag = namedtuple('SidebarTag', ['name', 'icon', 'url'])
+
+# 软过期后旧值的最长保留时间
+STALE_TIMEOUT = 60 * 60 * 24
+
+
+def get_cached(key, tags, timeout, load, background=False):
+    """
+    读取带标签的缓存, 不存在时加载并缓存
+    :param key: 缓存键
+    :param tags: 缓存标签
+    :param timeout: 软过期时间, 过期或标签失效后的旧值最多再保留 STALE_TIMEOUT
+    :param load: 加载函数, 返回 tuple
+    :param background: 过期或标签失效时是否先返回旧值, 由后台线程刷新
+    :return: 缓存值
+    """
+    def refresh():
+        versions = get_tag_versions(tags)
+        value = load()
+        set_tagged(key, (time.time() + timeout, value), versions, timeout + STALE_TIMEOUT)
+        return value
+
+    entry = get_tagged_stale(key)
+    if entry is not None:
+        (fresh_until, value), valid = entry
+        if valid and time.time() < fresh_until:
+            return value
+        if background:
+            refresh_in_background(key, refresh)
+            mark_stale_served()
+            return value
+    return refresh()
+
+
+def to_sidebar_article(article):
+    """
+    文章转为侧边栏文章, 需要 select_related('category')
+    """
+    return SidebarArticle(
+        title=article.title,
+        slug=article.slug,
+        url=article.get_absolute_url(),
+        cover_url=article.cover.url if article.cover else '',
+        category_name=article.category.name,
+        category_url=article.category.get_absolute_url(),
+        views=article.views,
+    )
+
+
+def get_footer_links(link_type):
+    """
+    页脚友情链接
+    :param link_type: 页面类型
+    """
+    def load():
+        links = Links.objects.filter(is_enable=True).filter(Q(show_type=link_type) | Q(show_type=LinkShowType.ALL))
+        return tuple(SidebarLink(link.name, link.link, link.notice) for link in links)
+    return get_cached('footer_links_{type}'.format(type=link_type), ['sidebar'], 60 * 60 * 60 * 3, load)
+
+
+def get_hot_articles():
+    """
+    热门文章
+    """
+    def load():
+        articles = list(Article.objects.filter(status='publish').select_related('category').order_by('-views')[
+                        :get_blog_setting().hot_article_count])
+        # 加上未写回数据库的浏览量
+        pending = view_counter.pending(article.pk for article in articles)
+        for article in articles:
+            article.views += pending.get(article.pk, 0)
+        return tuple(to_sidebar_article(article) for article in articles)
+    return get_cached('hot_articles', ['sidebar', 'article_list', 'category'], 60 * 10, load, background=True)
+
+
+def get_recent_comments():
+    """
+    最近评论
+    """
+    def load():
+        comments = Comment.objects.filter(is_enable=True).select_related('article__category').order_by('-id')[
+                   :get_blog_setting().comment_article_count]
+        return tuple(SidebarComment(comment.pk, comment.body, to_sidebar_article(comment.article))
+                     for comment in comments)
+    return get_cached('recent_comment_articles', ['sidebar', 'category'], 60 * 60 * 3, load, background=True)
+
+
+def get_extra_sections():
+    """
+    额外内容, 同时缓存渲染后的 html
+    """
+    def load():
+        sections = ExtraSection.objects.filter(is_enable=True).order_by('sequence')
+        return tuple(SidebarSection(section.name, CommonMarkdown.get_markdown(section.content))
+                     for section in sections)
+    return get_cached('extra_sections', ['sidebar'], 60 * 60 * 3, load, background=True)
+
+
+def load_category_tree():
+    """
+    全部分类组成的树, 只查询一次, 由 seo_processor 随全局上下文一起缓存
+    :return: 根分类, 子分类在 children 中, 同级按权重排序
+    """
+    children = {}
+    for category in Category.objects.order_by('-index'):
+        children.setdefault(category.parent_category_id, []).append(category)
+
+    def build(parent_id):
+        return tuple(SidebarCategory(category.name, category.icon, category.get_absolute_url(), build(category.pk))
+                     for category in children.get(parent_id, []))
+    return build(None)
+
+
+def load_tag_list():
+    """
+    全部标签, 由 seo_processor 随全局上下文一起缓存
+    """
+    return tuple(SidebarTag(tag.name, tag.icon, tag.get_absolute_url()) for tag in Tag.objects.all())
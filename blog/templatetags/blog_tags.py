@@ -5,23 +5,27 @@
 # @File    : blog_tags.py
 # @Software: PyCharm
 import logging
+import time
 
 from django import template
 from django.conf import settings
-from django.db.models import Q
 from django.shortcuts import get_object_or_404
 from django.template.defaultfilters import stringfilter
 from django.urls import reverse
+from django.utils.http import urlencode
 from django.utils.safestring import mark_safe
 
-from blog.models import Article, Category, Tag, ExtraSection, Links, LinkShowType
-from comments.models import Comment
-from utils.common import cache, CommonMarkdown
+from blog import sidebar
+from blog.models import Article, Category, Tag
+from utils.cache import cache, cache_metrics, get_key_family, make_fragment_key
+from utils.common import CommonMarkdown, get_blog_setting
 
 logger = logging.getLogger(__name__)
 
 register = template.Library()
 
+FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 10
+
 
 @register.simple_tag
 def query(qs, **kwargs):
@@ -34,6 +38,56 @@ def query(qs, **kwargs):
     return qs.filter(**kwargs)
 
 
+class FragmentCacheNode(template.Node):
+    def __init__(self, nodelist, name, tags, vary_on):
+        self.nodelist = nodelist
+        self.name = name
+        self.tags = tags
+        self.vary_on = vary_on
+
+    def render(self, context):
+        key = make_fragment_key(self.name, self.tags, [var.resolve(context) for var in self.vary_on])
+        family = get_key_family(key)
+        entry = cache.get(key)
+        if entry is not None:
+            content, render_seconds = entry
+            cache_metrics.record(family, 0, saved_seconds=render_seconds)
+            return mark_safe(content)
+        start = time.perf_counter()
+        content = self.nodelist.render(context)
+        render_seconds = time.perf_counter() - start
+        cache_metrics.record(family, 0, render_seconds=render_seconds)
+        cache.set(key, (str(content), render_seconds), FRAGMENT_CACHE_TIMEOUT)
+        return content
+
+
+@register.tag
+def fragment_cache(parser, token):
+    """
+    缓存渲染后的模板片段, 键中包含标签的版本号, 标签失效后重新渲染, 并统计渲染耗时和命中节省的耗时
+    用法: {% fragment_cache 'category_tree' 'category' vary_on active_page %}...{% endfragment_cache %}
+    :param parser: 模板解析器
+    :param token: 片段名、依赖的标签, vary_on 之后为区分片段的变量
+    :return: 片段缓存节点
+    """
+    bits = token.split_contents()
+    if 'vary_on' in bits:
+        index = bits.index('vary_on')
+        bits, vary_on = bits[:index], bits[index + 1:]
+    else:
+        vary_on = []
+    literals = bits[1:]
+    if len(literals) < 2:
+        raise template.TemplateSyntaxError("'%s' tag requires a name and at least one cache tag." % bits[0])
+    for bit in literals:
+        if bit[0] not in '\'"' or bit[-1] != bit[0]:
+            raise template.TemplateSyntaxError("'%s' tag name and cache tags must be quoted." % bits[0])
+    nodelist = parser.parse(('endfragment_cache',))
+    parser.delete_first_token()
+    return FragmentCacheNode(nodelist, literals[0][1:-1], [bit[1:-1] for bit in literals[1:]],
+                             [parser.compile_filter(var) for var in vary_on])
+
+
 @register.simple_tag
 def dateformat(data):
     """
@@ -64,19 +118,46 @@ def datetimeformat(data):
 
 @register.simple_tag
 def get_markdown_toc(content):
-    body, toc = CommonMarkdown.get_markdown_with_all(content)
+    """
+    返回 markdown 目录, 文章优先读取已保存的渲染结果
+    :param content: 文章或内容
+    :return: 安全的目录 html
+    """
+    if isinstance(content, Article):
+        body, toc = content.get_rendered_body()
+    else:
+        body, toc = CommonMarkdown.get_markdown_with_all(str(content))
     return mark_safe(toc)
 
 
+@register.simple_tag(takes_context=True)
+def get_article_render(context, article):
+    """
+    获取文章渲染结果(正文、目录、摘要), 同一请求内每篇文章只计算一次
+    :param context: 模板上下文
+    :param article: 文章
+    :return: ArticleRender
+    """
+    request = context.get('request')
+    if request is None:
+        return article.get_render()
+    renders = request.__dict__.setdefault('article_renders', {})
+    if article.pk not in renders:
+        renders[article.pk] = article.get_render()
+    return renders[article.pk]
+
+
 @register.filter
-@stringfilter
 def custom_markdown(content):
     """
-    返回安全的 markdown 内容
-    :param content: 内容
+    返回安全的 markdown 内容, 文章优先读取已保存的渲染结果
+    :param content: 文章或内容
     :return: 安全的 markdown 内容
     """
-    return mark_safe(CommonMarkdown.get_markdown(content))
+    if isinstance(content, Article):
+        body, toc = content.get_rendered_body()
+        return mark_safe(body)
+    return mark_safe(CommonMarkdown.get_markdown(str(content)))
 
 
 @register.filter
@@ -94,6 +175,18 @@ def strip_str(value: str, args):
         return value.strip('')
 
 
+@register.filter
+@stringfilter
+def with_prefix(value: str, prefix):
+    """
+    以指定前缀开头时返回原值, 否则返回空字符串, 用于片段缓存只按相关的页面区分
+    :param value: 字符串
+    :param prefix: 前缀
+    :return: 原值或空字符串
+    """
+    return value if value.startswith(prefix) else ''
+
+
 @register.inclusion_tag('base/tags/breadcrumb.html')
 def load_breadcrumb(breadcrumbs):
     """
@@ -111,15 +204,7 @@ def load_footer_links(link_type):
     :param link_type: 页面类型
     :return: 友情链接字典
     """
-    value = cache.get('footer_links')
-    if value:
-        return {'footer_links': value}
-    else:
-        logger.info("Loading footer links")
-        links = Links.objects.filter(is_enable=True).filter(Q(show_type=link_type) | Q(show_type=LinkShowType.ALL))
-        cache.set('footer_links', links, 60 * 60 * 60 * 3)
-        logger.info('set footer_links cache.key:{key}'.format(key='footer_links'))
-        return {'footer_links': links}
+    return {'footer_links': sidebar.get_footer_links(link_type)}
 
 
 @register.inclusion_tag('blog/tags/article_list.html')
@@ -158,18 +243,7 @@ def load_hot_articles():
     加载热门文章列表
     :return: 热门文章列表字典
     """
-    value = cache.get('hot_articles')
-    if value:
-        return {'article_list': value}
-    else:
-        logger.info('load hot articles')
-        from utils.common import get_blog_setting
-        blog_setting = get_blog_setting()
-        hot_articles = Article.objects.filter(status='publish').order_by('-views')[
-                             :blog_setting.hot_article_count]
-        cache.set("hot_articles", hot_articles, 60 * 60 * 60 * 3)
-        logger.info('set hot_articles cache.key:{key}'.format(key="hot_articles"))
-        return {'article_list': hot_articles}
+    return {'article_list': sidebar.get_hot_articles()}
 
 
 @register.inclusion_tag('blog/tags/recent_comment_articles.html')
@@ -178,21 +252,10 @@ def load_recent_comment_articles():
     加载最近评论文章列表
     :return: 最近评论文章列表字典
     """
-    value = cache.get('recent_comment_articles')
-    if value:
-        return value
-    else:
-        logger.info('load recent_comment_articles')
-        from utils.common import get_blog_setting
-        blog_setting = get_blog_setting()
-        comment_list = Comment.objects.filter(is_enable=True).order_by('-id')[:blog_setting.comment_article_count]
-        value = {
-            'recent_comments': comment_list,
-            'open_site_comment': blog_setting.open_site_comment,
-        }
-        cache.set("recent_comment_articles", value, 60 * 60 * 3)
-        logger.info('set recent_comment_articles cache.key:{key}'.format(key='recent_comment_articles'))
-        return value
+    return {
+        'recent_comments': sidebar.get_recent_comments(),
+        'open_site_comment': get_blog_setting().open_site_comment,
+    }
 
 
 @register.inclusion_tag('blog/tags/extra_sections.html')
@@ -201,15 +264,7 @@ def load_extra_sections():
     加载额外内容
     :return: 额外内容
     """
-    value = cache.get('extra_sections')
-    if value:
-        return {'extra_sections': value}
-    else:
-        logger.info('load extra_sections')
-        extra_sidebars = ExtraSection.objects.filter(is_enable=True).order_by('sequence')
-        cache.set("extra_sections", extra_sidebars, 60 * 60 * 3)
-        logger.info('set extra_sections cache.key:{key}'.format(key='extra_sections'))
-        return {'extra_sections': extra_sidebars}
+    return {'extra_sections': sidebar.get_extra_sections()}
 
 
 @register.filter
@@ -293,6 +348,10 @@ def load_pagination(paginator, page_obj, page_type, tag_name):
                 kwargs={
                     'page': previous_number,
                     'tag_name': tag.slug})
+    # 键集分页的下一页链接带上游标, 不需要由页码查找起始位置
+    next_cursor = getattr(page_obj, 'next_cursor', None)
+    if next_url and next_cursor:
+        next_url = '{url}?{query}'.format(url=next_url, query=urlencode({'cursor': next_cursor}))
     return {
         'previous_url': previous_url,
         'next_url': next_url,
@@ -1,9 +1,12 @@
+import time
+
 from django.core import mail
 from django.core.management import call_command
 from django.core.paginator import Paginator
 from django.test import TestCase, Client, RequestFactory
 from django.utils import timezone
 
+from blog.view_counter import view_counter
 from utils.common import send_email
 from .models import *
 from .templatetags.blog_tags import load_pagination
@@ -41,6 +44,10 @@ class ArticleTest(TestCase):
         self.client = Client()
         self.factory = RequestFactory()
 
+    def tearDown(self):
+        # 丢弃未写回的浏览量, 不带到其他测试
+        view_counter.buffer.drain()
+
     def test_validate_article(self):
         site = get_current_site().domain
         user = get_user_model().objects.get_or_create(
@@ -189,6 +196,713 @@ class ArticleTest(TestCase):
         response = self.client.get(s['next_url'])
         self.assertEqual(response.status_code, 200)
 
+    def test_article_render(self):
+        user = get_user_model().objects.create_user(
+            email="render@render.com",
+            username="render",
+            password="123456"
+        )
+        category = Category()
+        category.name = "render"
+        category.save()
+
+        article = Article()
+        article.title = "Render Article"
+        article.body = "# Title\n\ncontent"
+        article.author = user
+        article.category = category
+        article.status = "publish"
+        article.save()
+
+        article = Article.objects.get(pk=article.pk)
+        self.assertFalse(article.is_render_stale())
+        self.assertIn('content', article.body_html)
+        self.assertIn('Title', article.toc_html)
+        self.assertEqual(article.excerpt, 'Title content')
+        self.assertEqual(article.word_count, 2)
+        self.assertEqual(article.reading_time, 1)
+
+        # 中文按单字截断和计数
+        article.body = "中文" * 100
+        article.save()
+        self.assertEqual(article.word_count, 200)
+        self.assertEqual(article.excerpt, "中文" * 60 + " …")
+
+        # 仅更新正文而绕过 save 时, 读取渲染结果会重新渲染并写回数据库
+        Article.objects.filter(pk=article.pk).update(body="# Changed")
+        article = Article.objects.get(pk=article.pk)
+        self.assertTrue(article.is_render_stale())
+        body, toc = article.get_rendered_body()
+        self.assertIn('Changed', body)
+        self.assertFalse(Article.objects.get(pk=article.pk).is_render_stale())
+
+        # 详情页的摘要、目录和正文共享同一次渲染结果
+        from unittest import mock
+        with mock.patch.object(Article, 'get_render', autospec=True, side_effect=Article.get_render) as get_render:
+            response = self.client.get(article.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(get_render.call_count, 1)
+
+        # 摘要中的特殊字符只转义一次
+        article.body = "a < b & c"
+        article.save()
+        self.assertEqual(article.get_render().excerpt, 'a < b & c')
+        response = self.client.get(article.get_absolute_url())
+        self.assertContains(response, '<meta name="description" content="a &lt; b &amp; c"/>', html=False)
+        self.assertNotContains(response, 'contrib/auto-render.min.js')
+
+        # 正文中有客户端渲染的公式时才加载 KaTeX 脚本
+        article.body = "$a^2$"
+        article.save()
+        self.assertTrue(Article.objects.get(pk=article.pk).has_client_math)
+        response = self.client.get(article.get_absolute_url())
+        self.assertContains(response, 'contrib/auto-render.min.js')
+
+    def test_incremental_markdown(self):
+        from utils.common import CommonMarkdown
+        body = ("# First\n\ntext[^1] with [link][ref]\n\n## Second\n\n```python\nprint(1)\n```\n\n"
+                "::: info Tip\ntip\n:::\n\nafter\n\n[^1]: note\n\n[ref]: /ref/\n")
+        self.assertEqual(CommonMarkdown.get_markdown_incremental(body), CommonMarkdown.get_markdown_with_all(body))
+
+        # 修改一个块后只有这个块需要重新渲染
+        changed = body.replace('after', 'changed')
+        from unittest import mock
+        with mock.patch.object(CommonMarkdown, 'get_engine', wraps=CommonMarkdown.get_engine) as get_engine:
+            result = CommonMarkdown.get_markdown_incremental(changed)
+        # 一次渲染改动的块, 一次拼接目录
+        self.assertEqual(get_engine.call_count, 2)
+        self.assertEqual(result, CommonMarkdown.get_markdown_with_all(changed))
+
+        # 其他进程的进程内缓存为空时, 从 Django 缓存取回各块, 只需拼接目录
+        CommonMarkdown._block_cache.clear()
+        with mock.patch.object(CommonMarkdown, 'get_engine', wraps=CommonMarkdown.get_engine) as get_engine:
+            self.assertEqual(CommonMarkdown.get_markdown_incremental(changed), result)
+        self.assertEqual(get_engine.call_count, 1)
+
+        # 重复的标题锚点需要全文编号, 退回整篇渲染
+        body = "# Same\n\na\n\n# Same\n\nb"
+        self.assertEqual(CommonMarkdown.get_markdown_incremental(body), CommonMarkdown.get_markdown_with_all(body))
+
+    def test_code_hilite_cache(self):
+        from unittest import mock
+        from django.core.cache import cache
+        from utils.common import CommonMarkdown
+        # markdown.extensions.codehilite.CodeHilite 已被换成带缓存的子类, 统计原类的高亮次数
+        from utils.extensions import CachedCodeHilite, CodeHilite
+        CachedCodeHilite.local_cache.clear()
+        cache.clear()
+        body = "```python\nprint('cached')\n```\n\n    :::python\n    print('indented')"
+        with mock.patch.object(CodeHilite, 'hilite', autospec=True, side_effect=CodeHilite.hilite) as hilite:
+            article_html = CommonMarkdown.get_markdown(body)
+            # 评论中相同的代码片段直接命中缓存
+            comment_html = CommonMarkdown.get_markdown("```python\nprint('cached')\n```", 'comment')
+            # Django 缓存被清空后仍由进程内缓存命中
+            cache.clear()
+            CommonMarkdown.get_markdown(body)
+        # 围栏代码块和缩进代码块各高亮一次
+        self.assertEqual(hilite.call_count, 2)
+        self.assertIn('codehilite', article_html)
+        self.assertIn('codehilite', comment_html)
+
+    def test_katex_cache(self):
+        from unittest import mock
+        from django.core.cache import cache
+        from markdown_katex import wrapper
+        from utils.common import CommonMarkdown
+        from utils.extensions import katex_local_cache
+        katex_local_cache.clear()
+        cache.clear()
+        body = "$`a^2 + b^2`$\n\n```math\nc^2\n```"
+        with mock.patch.object(wrapper, 'tex2html', side_effect=wrapper.tex2html) as tex2html:
+            html = CommonMarkdown.get_markdown(body)
+            self.assertEqual(CommonMarkdown.get_markdown(body), html)
+        # 行内公式和公式块各渲染一次
+        self.assertEqual(tex2html.call_count, 2)
+        self.assertIn('katex', html)
+
+        # 只有服务端未渲染的 $...$ 需要加载客户端 KaTeX 脚本, 代码块中的 $ 不算
+        from utils.common import has_client_math
+        self.assertFalse(has_client_math(html))
+        self.assertFalse(has_client_math(CommonMarkdown.get_markdown("```bash\necho $HOME $PATH\n```")))
+        self.assertTrue(has_client_math(CommonMarkdown.get_markdown("price $x + y$ here")))
+
+    def test_cache_tags(self):
+        from django.core.cache import cache
+        from utils.cache import get_tagged, set_tagged
+        cache.clear()
+        user = get_user_model().objects.create_user(
+            email="tags@tags.com",
+            username="tags",
+            password="123456"
+        )
+        category = Category()
+        category.name = "tags"
+        category.save()
+
+        set_tagged('tagged_home', 'home', ['article_list'])
+        set_tagged('tagged_settings', 'settings', ['settings'])
+        cache.set('untagged', 'untagged')
+
+        article = Article()
+        article.title = "Tagged Article"
+        article.body = "content"
+        article.author = user
+        article.category = category
+        article.status = "publish"
+        article.save()
+
+        # 保存文章只失效依赖文章列表的缓存
+        self.assertIsNone(get_tagged('tagged_home'))
+        self.assertEqual(get_tagged('tagged_settings'), 'settings')
+        self.assertEqual(cache.get('untagged'), 'untagged')
+
+        # 保存配置失效配置相关缓存
+        set_tagged('tagged_home', 'home', ['article_list'])
+        BlogSettings.objects.create(site_name='tags')
+        self.assertIsNone(get_tagged('tagged_settings'))
+        self.assertEqual(get_tagged('tagged_home'), 'home')
+
+        # 计算期间标签失效, 旧值记在计算前读取的版本下, 不会被读取
+        from utils.cache import get_tag_versions, invalidate_tags
+        versions = get_tag_versions(['article_list'])
+        invalidate_tags('article_list')
+        set_tagged('tagged_home', 'stale home', versions)
+        self.assertIsNone(get_tagged('tagged_home'))
+
+        # 整页缓存在渲染期间失效时不缓存旧页面
+        from unittest import mock
+        from blog.views import HomeView
+        render = HomeView.get_context_data
+
+        def render_and_invalidate(view, **kwargs):
+            invalidate_tags('article_list')
+            return render(view, **kwargs)
+        with mock.patch.object(HomeView, 'get_context_data', autospec=True, side_effect=render_and_invalidate) as rendered:
+            self.client.get('/')
+            self.client.get('/')
+        self.assertEqual(rendered.call_count, 2)
+
+    def test_cache_decorator(self):
+        from unittest import mock
+        from django.core.cache import cache
+        from utils.cache import cache_metrics, make_cache_key
+        cache.clear()
+        cache_metrics.reset()
+        first = Tag.objects.create(name="same")
+        second = Tag(pk=first.pk + 1, name="same", last_mod_time=first.last_mod_time)
+        func = Tag.get_article_count.__wrapped__
+        # 同名不同主键的实例不会共用缓存, 重新查询的同一实例键不变
+        self.assertNotEqual(make_cache_key(func, (first,), {}), make_cache_key(func, (second,), {}))
+        self.assertEqual(make_cache_key(func, (first,), {}),
+                         make_cache_key(func, (Tag.objects.get(pk=first.pk),), {}))
+
+        self.assertEqual(first.get_article_count(), 0)
+        self.assertEqual(first.get_article_count(), 0)
+        family = 'func:blog.models.Tag.get_article_count'
+        stats = cache_metrics.snapshot()[family]
+        self.assertEqual((stats['hits'], stats['stale'], stats['misses']), (1, 0, 1))
+
+        # 过期后其他请求持有锁时直接返回旧值, 不重复计算
+        key = make_cache_key(func, (first,), {})
+        with mock.patch('utils.common.time.time', return_value=time.time() + 60 * 60 * 11):
+            cache.add(key + ':lock', 1)
+            with self.assertNumQueries(0):
+                self.assertEqual(first.get_article_count(), 0)
+            cache.delete(key + ':lock')
+            with self.assertNumQueries(1):
+                self.assertEqual(first.get_article_count(), 0)
+        self.assertEqual(cache_metrics.snapshot()[family]['stale'], 2)
+        # 按函数的统计随其他类别一起写入缓存, 管理命令和后台页面可以看到
+        row = [row for row in cache_metrics.report() if row['family'] == family][0]
+        self.assertEqual(row['stale'], 2)
+
+        # 缓存缺失且等待超时后自行计算, 不释放其他请求持有的锁
+        cache.delete(key)
+        cache.add(key + ':lock', 1)
+        with mock.patch('utils.common.SINGLE_FLIGHT_WAIT', 0):
+            self.assertEqual(first.get_article_count(), 0)
+        self.assertEqual(cache.get(key + ':lock'), 1)
+        cache.delete(key + ':lock')
+
+    def test_list_cache(self):
+        from django.core.cache import cache
+        from utils.cache import get_tagged
+        cache.clear()
+        user = get_user_model().objects.create_user(
+            email="list@list.com",
+            username="list",
+            password="123456"
+        )
+        category = Category.objects.create(name="list")
+        for i in range(3):
+            Article.objects.create(title="List Article %d" % i, body="body %d" % i, author=user,
+                                   category=category, status="publish")
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "List Article 2")
+        # 列表缓存只保存文章 id
+        ids = get_tagged('blog_home')
+        self.assertEqual(ids, list(Article.objects.filter(status='publish').values_list('id', flat=True)))
+        response = self.client.get('/archive/')
+        self.assertContains(response, "List Article 0")
+
+    def test_sidebar_queries(self):
+        from django.core.cache import cache
+        from django.template import Context, Template
+        from blog.context_processors import seo_processor
+        from comments.models import Comment
+        cache.clear()
+        user = get_user_model().objects.create_user(
+            email="sidebar@sidebar.com",
+            username="sidebar",
+            password="123456"
+        )
+        category = Category.objects.create(name="sidebar")
+        article = Article.objects.create(title="Sidebar Article", body="body", author=user,
+                                         category=category, status="publish")
+        # 绕过信号, 不发送评论邮件
+        Comment.objects.bulk_create([Comment(body="sidebar comment", author=user, article=article, is_enable=True)])
+        ExtraSection.objects.create(name="extra", content="**extra**", sequence=1)
+        Links.objects.create(name="link", link="https://link.com", master="m", email="m@m.com", sequence=1,
+                             is_enable=True, show_type=LinkShowType.ALL)
+        Tag.objects.create(name="sidebar tag")
+
+        template = Template("{% load blog_tags %}{% load_hot_articles %}{% load_recent_comment_articles %}"
+                            "{% load_extra_sections %}{% load_footer_links 'i' %}"
+                            "{% for tag in tag_list %}{% include 'base/tag_node.html' %}{% endfor %}")
+        request = self.factory.get('/')
+        template.render(Context(seo_processor(request)))
+        # 缓存预热后渲染侧边栏不再访问数据库
+        with self.assertNumQueries(0):
+            html = template.render(Context(seo_processor(request)))
+        for text in ["Sidebar Article", "sidebar comment", "<strong>extra</strong>", "https://link.com",
+                     "sidebar tag"]:
+            self.assertIn(text, html)
+
+    def test_page_cache(self):
+        from django.core.cache import cache
+        cache.clear()
+        user = get_user_model().objects.create_user(
+            email="page@page.com",
+            username="page",
+            password="123456"
+        )
+        category = Category.objects.create(name="page")
+        article = Article.objects.create(title="Page Article", body="page body", author=user,
+                                         category=category, status="publish")
+        url = article.get_absolute_url()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        # 命中缓存时不访问数据库, 浏览量写回前累加在计数中
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response['ETag'], etag)
+        view_counter.flush()
+        self.assertEqual(Article.objects.get(pk=article.pk).views, 2)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # 评论通过审核后页面缓存失效
+        from unittest import mock
+        from blog.page_cache import get_page_cache_key
+        from comments.models import Comment
+        from utils.cache import get_tagged
+        key = get_page_cache_key(self.factory.get(url))
+        self.assertIsNotNone(get_tagged(key))
+        comment = Comment.objects.create(body="page comment", author=user, article=article, is_enable=False)
+        comment.is_enable = True
+        with mock.patch('signals.common._thread.start_new_thread'):
+            comment.save()
+        self.assertIsNone(get_tagged(key))
+
+        # 修改文章后 ETag 改变
+        article.body = "page body changed"
+        article.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # http 和 https 页面中的绝对地址不同, 分开缓存
+        self.assertNotEqual(key, get_page_cache_key(self.factory.get(url, secure=True)))
+
+        # 后台批量改为草稿不发送信号, 同样需要失效页面缓存
+        from blog.admin import ArticleAdmin
+        self.assertIsNotNone(get_tagged(key))
+        self.assertEqual(ArticleAdmin.update_articles(Article.objects.filter(status='publish'), status='draft'), 1)
+        self.assertIsNone(get_tagged(key))
+        self.assertEqual(self.client.get(url).status_code, 404)
+        ArticleAdmin.update_articles(Article.objects.filter(pk=article.pk), status='publish')
+
+        # 登录用户不使用整页缓存
+        self.client.login(username='page', password='123456')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_cache_metrics(self):
+        from utils.cache import cache_metrics, get_key_family
+        from utils.common import cache
+        self.assertEqual(get_key_family('category_python_2'), 'category')
+        self.assertEqual(get_key_family('page_cache:' + '0' * 64), 'page_cache')
+        self.assertEqual(get_key_family('cache_func:blog.models.Tag.get_article_count:abc:lock'),
+                         'cache_func:blog.models.Tag.get_article_count:lock')
+        # 固定键保留键名, 其他无法识别的键不单独成类, 验证码按前缀归类
+        self.assertEqual(get_key_family('seo_processor'), 'seo_processor')
+        self.assertEqual(get_key_family('someone@example.com'), 'other')
+        self.assertEqual(get_key_family('email_code:someone@example.com'), 'email_code')
+
+        cache_metrics.reset()
+        cache.set('category_metrics_1', 'x' * 100)
+        cache.get('category_metrics_1')
+        cache.get('category_metrics_2')
+        row = [row for row in cache_metrics.report() if row['family'] == 'category'][0]
+        self.assertEqual((row['hits'], row['misses'], row['sets']), (1, 1, 1))
+        self.assertGreater(row['max_bytes'], 100)
+
+        # 写入大小按类别抽样测量, 总大小按测量结果估算
+        for i in range(cache_metrics.size_sample_rate):
+            cache.set('tag_metrics_{i}'.format(i=i), 'x' * 100)
+        stats = cache_metrics.snapshot()['tag']
+        self.assertEqual((stats['sets'], stats['sized']), (cache_metrics.size_sample_rate, 1))
+        row = [row for row in cache_metrics.report() if row['family'] == 'tag'][0]
+        self.assertEqual(row['bytes'], row['avg_bytes'] * cache_metrics.size_sample_rate)
+
+        # 其他进程写入各自的槽位, 汇总时合并所有槽位
+        from utils.cache import CacheMetrics
+        other = CacheMetrics()
+        other.get_worker = lambda: 'other:1'
+        other.record('category', 0, hits=2)
+        other.flush()
+        self.assertEqual(len(cache_metrics.get_slot_keys()), 2)
+        row = [row for row in cache_metrics.report() if row['family'] == 'category'][0]
+        self.assertEqual(row['hits'], 3)
+
+        url = reverse('admin:blog_cache_metrics')
+        self.assertEqual(self.client.get(url).status_code, 302)
+        get_user_model().objects.create_superuser(email="metrics@metrics.com", username="metrics",
+                                                  password="123456")
+        self.client.login(username='metrics', password='123456')
+        response = self.client.get(url, {'sort': 'max_bytes'})
+        self.assertContains(response, 'category')
+
+    def test_sidebar_background_refresh(self):
+        from unittest import mock
+        from django.core.cache import cache
+        from blog import sidebar
+        from utils.cache import invalidate_tags
+        cache.clear()
+        user = get_user_model().objects.create_user(
+            email="refresh@refresh.com",
+            username="refresh",
+            password="123456"
+        )
+        category = Category.objects.create(name="refresh")
+        Article.objects.create(title="Old Hot", body="body", author=user, category=category, status="publish")
+        self.assertEqual([article.title for article in sidebar.get_hot_articles()], ["Old Hot"])
+
+        Article.objects.create(title="New Hot", body="body", author=user, category=category, status="publish",
+                               views=10)
+        invalidate_tags('sidebar')
+        # 标签失效后先返回旧值, 由后台刷新
+        with mock.patch('blog.sidebar.refresh_in_background') as refresh:
+            with self.assertNumQueries(0):
+                self.assertEqual([article.title for article in sidebar.get_hot_articles()], ["Old Hot"])
+        self.assertEqual(refresh.call_count, 1)
+        refresh.call_args[0][1]()
+        self.assertEqual([article.title for article in sidebar.get_hot_articles()], ["New Hot", "Old Hot"])
+
+        # 用到旧值的页面不进整页缓存, 后台刷新完成后再缓存
+        invalidate_tags('sidebar')
+        with mock.patch('blog.sidebar.refresh_in_background') as refresh:
+            self.client.get('/')
+            with mock.patch('blog.views.HomeView.get_context_data', side_effect=AssertionError):
+                with self.assertRaises(AssertionError):
+                    self.client.get('/')
+        for call in refresh.call_args_list:
+            call[0][1]()
+        self.client.get('/')
+        with mock.patch('blog.views.HomeView.get_context_data', side_effect=AssertionError):
+            self.assertEqual(self.client.get('/').status_code, 200)
+
+    def test_near_cache(self):
+        from unittest import mock
+        from django.core.cache import cache
+        from utils.common import get_blog_setting
+        from blog.context_processors import seo_processor
+        request = self.factory.get('/')
+        setting = get_blog_setting()
+        get_current_site()
+        seo_processor(request)
+        # 近端缓存有效期内不访问缓存后端
+        with mock.patch.object(cache, 'get', side_effect=AssertionError), \
+                mock.patch.object(cache, 'get_many', side_effect=AssertionError):
+            self.assertEqual(get_blog_setting().pk, setting.pk)
+            get_current_site()
+            seo_processor(request)
+
+        # 修改配置后本进程立即生效
+        setting.site_name = 'near cache'
+        setting.save()
+        self.assertEqual(get_blog_setting().site_name, 'near cache')
+
+    def test_fragment_cache(self):
+        from django.core.cache import cache
+        from django.template import Context, Template
+        from utils.cache import cache_metrics, invalidate_tags
+        cache.clear()
+        cache_metrics.reset()
+        Category.objects.create(name="fragment")
+        tpl = Template("{% load blog_tags %}{% fragment_cache 'category_names' 'category' vary_on page %}"
+                       "{% for category in categories %}{{ category.name }}{% endfor %}{% endfragment_cache %}")
+
+        def render(page='/'):
+            return tpl.render(Context({'categories': Category.objects.order_by('id'), 'page': page}))
+
+        self.assertEqual(render(), 'fragment')
+        # 命中片段缓存时不执行片段内的查询, bulk_create 不触发信号
+        Category.objects.bulk_create([Category(name="added", slug="added")])
+        with self.assertNumQueries(0):
+            self.assertEqual(render(), 'fragment')
+        self.assertEqual(render('/other/'), 'fragmentadded')
+
+        # 标签版本变化后键随之改变
+        invalidate_tags('category')
+        self.assertEqual(render(), 'fragmentadded')
+        row = [row for row in cache_metrics.report() if row['family'] == 'fragment:category_names'][0]
+        self.assertEqual((row['hits'], row['misses'], row['renders']), (1, 3, 3))
+        self.assertGreater(row['saved_ms'], 0)
+
+        # 分类目录只按分类页面区分, 其他列表页共用一份
+        tpl = Template("{% load blog_tags %}{% fragment_cache 'category_drawer' 'category' vary_on "
+                       "page|with_prefix:'/category/' %}{{ page }}{% endfragment_cache %}")
+        for page in ['/page/2/', '/tag/python/', '/category/python/']:
+            tpl.render(Context({'page': page}))
+        row = [row for row in cache_metrics.report() if row['family'] == 'fragment:category_drawer'][0]
+        self.assertEqual((row['hits'], row['misses']), (1, 2))
+
+    def test_view_counter(self):
+        view_counter.flush()
+        user = get_user_model().objects.create_user(
+            email="views@views.com",
+            username="views",
+            password="123456"
+        )
+        category = Category.objects.create(name="views")
+        first = Article.objects.create(title="First Views", body="body", author=user, category=category,
+                                       status="publish", views=5)
+        second = Article.objects.create(title="Second Views", body="body", author=user, category=category,
+                                        status="publish")
+        # 浏览时不写数据库, 显示的浏览量包含未写回的增量
+        first.viewed()
+        with self.assertNumQueries(0):
+            first.viewed()
+            second.viewed()
+        first = Article.objects.get(pk=first.pk)
+        first.viewed()
+        self.assertEqual(first.views, 8)
+        self.assertEqual(view_counter.pending([first.pk, second.pk]), {first.pk: 3, second.pk: 1})
+
+        # 所有增量合并成一条 UPDATE
+        with self.assertNumQueries(1):
+            self.assertEqual(view_counter.flush(), 2)
+        self.assertEqual(Article.objects.get(pk=first.pk).views, 8)
+        self.assertEqual(Article.objects.get(pk=second.pk).views, 1)
+        self.assertEqual(view_counter.pending([first.pk]), {})
+
+        # 只有带正确值的预热请求头不计入浏览量, 伪造的请求头照常计数
+        from blog.page_cache import WARM_CACHE_HEADER, get_warm_token
+        self.client.get(second.get_absolute_url(), **{WARM_CACHE_HEADER: '1'})
+        self.client.get(second.get_absolute_url(), **{WARM_CACHE_HEADER: get_warm_token()})
+        self.assertEqual(view_counter.pending([second.pk]), {second.pk: 1})
+        view_counter.flush()
+
+        # redis 中的计数哈希已被同时执行的写回取走时, 改名失败返回空
+        from unittest import mock
+        from redis.exceptions import ResponseError
+        from blog.view_counter import RedisViewBuffer
+        backend = mock.Mock()
+        backend.make_and_validate_key.return_value = ':1:article_views'
+        backend._cache.get_client.return_value.rename.side_effect = ResponseError('no such key')
+        self.assertEqual(RedisViewBuffer(backend).drain(), {})
+
+    def test_article_cards(self):
+        from unittest import mock
+        from django.core.cache import cache
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from utils.cache import near_cache
+        from utils.common import get_blog_setting
+        from .views import ArticleListView
+        cache.clear()
+        near_cache.clear()
+        get_blog_setting()
+        user = get_user_model().objects.create_user(
+            email="card@card.com",
+            username="card",
+            password="123456"
+        )
+        category = Category.objects.create(name="card")
+        tag = Tag.objects.create(name="card")
+
+        def add_articles(count):
+            for i in range(Article.objects.count(), Article.objects.count() + count):
+                article = Article.objects.create(title="Card {i}".format(i=i), body="body", author=user,
+                                                 category=category, status="publish")
+                article.tags.add(tag)
+
+        def count_queries(url):
+            cache.clear()
+            near_cache.clear()
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            return len(context)
+
+        # 列表页的查询次数与每页文章数无关
+        add_articles(2)
+        queries = count_queries(reverse('blog:archive'))
+        add_articles(10)
+        self.assertEqual(count_queries(reverse('blog:archive')), queries)
+        for url in [tag.get_absolute_url(), category.get_absolute_url(), reverse('blog:page', kwargs={'page': 1})]:
+            with mock.patch.object(ArticleListView, 'paginate_by', 2):
+                queries = count_queries(url)
+            with mock.patch.object(ArticleListView, 'paginate_by', 10):
+                self.assertEqual(count_queries(url), queries)
+
+        articles = list(Article.objects.cards())
+        with self.assertNumQueries(0):
+            for article in articles:
+                self.assertEqual((article.category.name, article.author.username), ("card", "card"))
+                self.assertEqual([tag.name for tag in article.tags.all()], ["card"])
+        self.assertEqual(articles[0].get_deferred_fields(), set(ArticleQuerySet.CARD_DEFERRED_FIELDS))
+
+    def test_category_path(self):
+        from django.core.exceptions import ValidationError
+        root = Category.objects.create(name="root")
+        child = Category.objects.create(name="child", parent_category=root)
+        leaf = Category.objects.create(name="leaf", parent_category=child)
+        other = Category.objects.create(name="other")
+        self.assertEqual(leaf.path, '/{root}/{child}/{leaf}/'.format(root=root.pk, child=child.pk, leaf=leaf.pk))
+
+        # 祖先和子孙各一次查询
+        with self.assertNumQueries(1):
+            self.assertEqual(set(root.get_descendants()), {root, child, leaf})
+        with self.assertNumQueries(1):
+            self.assertEqual(set(leaf.get_ancestors()), {root, child, leaf})
+        self.assertEqual(leaf.get_category_tree(), [leaf, child, root])
+
+        # 调整层级后子分类的路径随之更新
+        child.parent_category = other
+        child.save()
+        leaf.refresh_from_db()
+        self.assertEqual(leaf.path, '/{other}/{child}/{leaf}/'.format(other=other.pk, child=child.pk, leaf=leaf.pk))
+        self.assertEqual(set(root.get_descendants()), {root})
+        self.assertEqual(set(other.get_descendants()), {other, child, leaf})
+        other.parent_category = leaf
+        self.assertRaises(ValidationError, other.clean)
+
+        user = get_user_model().objects.create_user(
+            email="path@path.com",
+            username="path",
+            password="123456"
+        )
+        Article.objects.create(title="Leaf Article", body="body", author=user, category=leaf, status="publish")
+        response = self.client.get(reverse('blog:category_detail', kwargs={'category_name': other.slug}))
+        self.assertContains(response, "Leaf Article")
+
+    def test_category_tree(self):
+        from blog.sidebar import load_category_tree
+        root = Category.objects.create(name="tree_root", index=1)
+        child = Category.objects.create(name="tree_child", parent_category=root)
+        Category.objects.create(name="tree_leaf", parent_category=child)
+        Category.objects.create(name="tree_first", index=2)
+        with self.assertNumQueries(1):
+            tree = load_category_tree()
+        self.assertEqual([category.name for category in tree], ["tree_first", "tree_root"])
+        self.assertEqual(tree[1].children[0].url, child.get_absolute_url())
+        self.assertEqual(tree[1].children[0].children[0].name, "tree_leaf")
+
+        response = self.client.get(root.get_absolute_url())
+        self.assertContains(response, "tree_leaf")
+        self.assertContains(response, 'href="{url}"\n           class="relative'.format(url=root.get_absolute_url()))
+
+    def test_keyset_pagination(self):
+        from django.core.cache import cache
+        from django.core.paginator import EmptyPage, PageNotAnInteger
+        from unittest import mock
+        from .paginator import KeysetPaginator
+        from .views import ArticleListView
+        cache.clear()
+        user = get_user_model().objects.create_user(
+            email="keyset@keyset.com",
+            username="keyset",
+            password="123456"
+        )
+        category = Category.objects.create(name="keyset")
+        for i in range(8):
+            Article.objects.create(title="Keyset {i}".format(i=i), body="body", author=user, category=category,
+                                   status="publish", article_order=int(i == 5))
+        # 创建时间相同的文章按 id 排序
+        Article.objects.filter(title__in=["Keyset 1", "Keyset 2", "Keyset 3"]).update(
+            created_time=timezone.now())
+        articles = Article.objects.filter(status='publish')
+        expected = list(articles.order_by('-article_order', '-created_time', '-id'))
+
+        paginator = KeysetPaginator(articles, 3)
+        pages = [paginator.page(number) for number in (1, 2, 3)]
+        self.assertEqual([article for page in pages for article in page], expected)
+        self.assertEqual([page.has_next() for page in pages], [True, True, False])
+        self.assertEqual((paginator.count, paginator.num_pages), (8, 3))
+        self.assertRaises(EmptyPage, paginator.page, 4)
+        self.assertRaises(PageNotAnInteger, paginator.seek, 'not a cursor')
+
+        # 页码对应的游标已缓存时只查询当前页
+        with self.assertNumQueries(1):
+            self.assertEqual(list(KeysetPaginator(articles, 3).page(3)), expected[6:])
+        # 缓存失效后 COUNT 一次确认页码不超出范围, 再从第一页一次查询补齐各页游标
+        cache.clear()
+        with self.assertNumQueries(3):
+            self.assertEqual(list(KeysetPaginator(articles, 3).page(3)), expected[6:])
+        # 超出总页数的页码不逐页查询; 请求的页不存在时, 途中补齐的游标也会保存
+        from utils.cache import invalidate_tags
+        with self.assertNumQueries(0):
+            self.assertRaises(EmptyPage, KeysetPaginator(articles, 3).page, 999999)
+        invalidate_tags('article_list')
+        with self.assertNumQueries(2):
+            self.assertRaises(EmptyPage, KeysetPaginator(articles, 3).page, 4)
+        with self.assertNumQueries(1):
+            self.assertRaises(EmptyPage, KeysetPaginator(articles, 3).page, 4)
+
+        # 带游标时直接定位, 不读取页码对应的游标和总数
+        next_cursor = KeysetPaginator(articles, 3).page(1).next_cursor
+        with self.assertNumQueries(1):
+            page = KeysetPaginator(articles, 3).page(2, next_cursor)
+        self.assertEqual(list(page), expected[3:6])
+        self.assertTrue(page.has_next())
+
+        with mock.patch.object(ArticleListView, 'paginate_by', 3):
+            response = self.client.get(reverse('blog:page', kwargs={'page': 3}))
+            self.assertContains(response, expected[6].title)
+            self.assertNotContains(response, expected[5].title)
+            self.assertEqual(self.client.get(reverse('blog:page', kwargs={'page': 4})).status_code, 404)
+            # 下一页链接带上游标
+            response = self.client.get(reverse('blog:page', kwargs={'page': 2}))
+            next_url = '{url}?cursor={cursor}'.format(url=reverse('blog:page', kwargs={'page': 3}),
+                                                      cursor=response.context['page_obj'].next_cursor)
+            self.assertContains(response, 'href="{url}"'.format(url=next_url))
+            response = self.client.get(next_url)
+            self.assertContains(response, expected[6].title)
+            self.assertNotContains(response, expected[5].title)
+
+        # 近似总数与游标使用相同的标签, 发布文章后新增的页可以访问
+        for i in range(8, 12):
+            Article.objects.create(title="Keyset {i}".format(i=i), body="body", author=user, category=category,
+                                   status="publish")
+        paginator = KeysetPaginator(articles, 3)
+        self.assertEqual(len(paginator.page(4)), 3)
+        self.assertEqual(paginator.count, 12)
+
     def test_error_page(self):
         rsp = self.client.get('/error/')
         self.assertEqual(rsp.status_code, 404)
@@ -200,3 +914,41 @@ class ArticleTest(TestCase):
         call_command("ping_baidu", "all")
         call_command("create_test_data")
         call_command("clear_cache")
+        call_command("benchmark_markdown", iterations=1)
+
+        Article.objects.update(body="# Prerender")
+        call_command("prerender_articles", workers=1, chunk_size=2)
+        call_command("prerender_articles", since="2000-01-01")
+        article = Article.objects.first()
+        self.assertFalse(article.is_render_stale())
+        self.assertIn('Prerender', article.body_html)
+
+        # 渲染版本变化后默认运行也会重新渲染, 并失效文章和列表的缓存
+        from io import StringIO
+        from unittest import mock
+        from utils.cache import get_tag_versions
+        from utils.common import CommonMarkdown
+        versions = get_tag_versions(['article_list', 'article:{id}'.format(id=article.id)])
+        with mock.patch.object(CommonMarkdown, 'RENDER_VERSION', CommonMarkdown.RENDER_VERSION + 1):
+            self.assertTrue(Article.objects.get(pk=article.pk).is_render_stale())
+            out = StringIO()
+            call_command("prerender_articles", workers=1, stdout=out)
+            self.assertIn('prerendered {count} articles'.format(
+                count=Article.objects.filter(status='publish').count()), out.getvalue())
+            self.assertFalse(Article.objects.get(pk=article.pk).is_render_stale())
+        self.assertNotEqual(get_tag_versions(['article_list', 'article:{id}'.format(id=article.id)]), versions)
+
+        out = StringIO()
+        call_command("warm_cache", concurrency=1, limit=3, stdout=out, stderr=StringIO())
+        self.assertIn('warmed 3 urls', out.getvalue())
+        # 默认按 https 预热, https 请求命中缓存的页面, 其中是 https 链接
+        from blog.page_cache import get_page_cache_key
+        from utils.cache import get_tagged
+        from utils.common import get_current_site
+        host = get_current_site().domain
+        self.assertIsNotNone(get_tagged(get_page_cache_key(self.factory.get('/', HTTP_HOST=host, secure=True))))
+        response = self.client.get('/', HTTP_HOST=host, secure=True)
+        self.assertContains(response, '<link rel="canonical" href="https://')
+        call_command("cache_metrics", sort="avg_ms", stdout=out)
+        call_command("cache_metrics", reset=True, stdout=out)
+        call_command("flush_views", stdout=out)
@@ -6,7 +6,6 @@
 # @Software: PyCharm
 from django.contrib.sitemaps.views import sitemap
 from django.urls import path
-from django.views.decorators.cache import cache_page
 
 from backends.elasticsearch_backend import ElasticSearchModelSearchForm
 from blog import views
@@ -32,7 +31,7 @@ urlpatterns = [
     path('author/<str:author_name>/<int:page>/', views.AuthorDetailView.as_view(), name='author_detail_page'),
     path('tag/<slug:tag_name>/', views.TagDetailView.as_view(), name='tag_detail'),
     path('tag/<slug:tag_name>/<int:page>/', views.TagDetailView.as_view(), name='tag_detail_page'),
-    path('archive/', cache_page(60 * 60)(views.ArchivesView.as_view()), name='archive'),
+    path('archive/', views.ArchivesView.as_view(), name='archive'),
     path('links/', views.LinkListView.as_view(), name='links'),
     path('links/apply/', views.apply_roll, name='apply_roll'),
     path('feed/', BlogFeed(), name='feed'),
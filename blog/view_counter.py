@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2024/12/30 20:40
+# @Author  : Joker
+# @File    : view_counter.py
+# @Software: PyCharm
+# @Description: 文章浏览量缓冲计数, 请求中只累加计数, 定期把增量合并成一条 UPDATE 写回数据库
+import atexit
+import logging
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+from django.db.models import Case, F, PositiveIntegerField, When
+from redis.exceptions import ResponseError
+
+from utils.cache import refresh_in_background
+
+logger = logging.getLogger(__name__)
+
+VIEW_COUNTER_KEY = 'article_views'
+# 每条 UPDATE 最多更新的文章数
+FLUSH_BATCH_SIZE = 500
+
+
+class LocalViewBuffer:
+    """
+    进程内计数, 本地内存缓存时使用, 各进程分别写回自己的增量
+    """
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def incr(self, pk):
+        with self._lock:
+            self._counts[pk] += 1
+            return self._counts[pk]
+
+    def pending(self, pks):
+        with self._lock:
+            return {pk: self._counts[pk] for pk in pks if pk in self._counts}
+
+    def drain(self):
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+        return dict(counts)
+
+    def restore(self, counts):
+        with self._lock:
+            self._counts.update(counts)
+
+
+class RedisViewBuffer:
+    """
+    redis 哈希计数, HINCRBY 是原子操作, 所有进程共用一份增量
+    """
+
+    def __init__(self, backend):
+        self._key = backend.make_and_validate_key(VIEW_COUNTER_KEY)
+        self._backend = backend
+
+    def get_client(self):
+        return self._backend._cache.get_client(self._key, write=True)
+
+    def incr(self, pk):
+        return self.get_client().hincrby(self._key, pk, 1)
+
+    def pending(self, pks):
+        pks = list(pks)
+        if not pks:
+            return {}
+        values = self.get_client().hmget(self._key, pks)
+        return {pk: int(value) for pk, value in zip(pks, values) if value is not None}
+
+    def drain(self):
+        """
+        先把计数哈希改名再读取, 改名之后的计数写入新的哈希, 不会丢失
+        改名是原子操作, 同时写回时只有一方能取走计数, 另一方改名失败返回空
+        """
+        client = self.get_client()
+        draining = '{key}:flushing:{id}'.format(key=self._key, id=uuid.uuid4().hex)
+        try:
+            client.rename(self._key, draining)
+        except ResponseError:
+            # 计数哈希不存在: 没有新的浏览, 或已被其他进程取走
+            return {}
+        counts = client.hgetall(draining)
+        client.delete(draining)
+        return {int(pk): int(count) for pk, count in counts.items()}
+
+    def restore(self, counts):
+        pipeline = self.get_client().pipeline()
+        for pk, count in counts.items():
+            pipeline.hincrby(self._key, pk, count)
+        pipeline.execute()
+
+
+class ViewCounter:
+    """
+    文章浏览量计数, 显示的浏览量为数据库中的值加上未写回的增量
+    """
+
+    def __init__(self, flush_interval=10):
+        self.flush_interval = flush_interval
+        self._buffer = None
+        self._last_flush = time.monotonic()
+
+    @property
+    def buffer(self):
+        if self._buffer is None:
+            backend = caches['default']
+            self._buffer = RedisViewBuffer(backend) if isinstance(backend, RedisCache) else LocalViewBuffer()
+        return self._buffer
+
+    def incr(self, pk):
+        """
+        浏览量加一, 不访问数据库, 超过写回间隔时由后台线程写回
+        :param pk: 文章 id
+        :return: 该文章未写回的增量
+        """
+        count = self.buffer.incr(pk)
+        if not settings.TESTING and time.monotonic() - self._last_flush > self.flush_interval:
+            self._last_flush = time.monotonic()
+            refresh_in_background(VIEW_COUNTER_KEY, self.flush)
+        return count
+
+    def pending(self, pks):
+        """
+        未写回的增量
+        :param pks: 文章 id 列表
+        :return: {文章 id: 增量}
+        """
+        return self.buffer.pending(pks)
+
+    def flush(self):
+        """
+        把增量写回数据库, 每批一条 UPDATE ... SET views = CASE ..., 写入失败时把增量放回
+        :return: 写回的文章数
+        """
+        counts = self.buffer.drain()
+        pks = sorted(counts)
+        article_model = apps.get_model('blog', 'Article')
+        for start in range(0, len(pks), FLUSH_BATCH_SIZE):
+            batch = pks[start:start + FLUSH_BATCH_SIZE]
+            try:
+                # queryset.update 不触发信号, 不会让页面缓存失效
+                article_model.objects.filter(pk__in=batch).update(views=Case(
+                    *[When(pk=pk, then=F('views') + counts[pk]) for pk in batch], default=F('views'),
+                    output_field=PositiveIntegerField()))
+            except Exception as e:
+                logger.error('flush article views failed:{error}'.format(error=e))
+                self.buffer.restore({pk: counts[pk] for pk in pks[start:]})
+                return start
+        return len(pks)
+
+
+view_counter = ViewCounter()
+
+
+def flush_on_exit():
+    # 进程内计数在进程退出前写回
+    if isinstance(view_counter._buffer, LocalViewBuffer):
+        try:
+            view_counter.flush()
+        except Exception as e:
+            logger.error('flush article views on exit failed:{error}'.format(error=e))
+
+
+# 测试中的计数属于已销毁的测试数据库, 退出时不能写入当前配置的数据库
+if not settings.TESTING:
+    atexit.register(flush_on_exit)
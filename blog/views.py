@@ -1,7 +1,7 @@
 import logging
 
-from django.core.paginator import Paginator
-from django.http import HttpResponseRedirect, HttpResponseForbidden
+from django.core.paginator import InvalidPage, Paginator
+from django.http import Http404, HttpResponseRedirect, HttpResponseForbidden
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
 from django.views import generic
@@ -10,9 +10,13 @@ from django.views.generic import DetailView
 
 from blog.forms import LinksForm
 from blog.models import Article, LinkShowType, Category, Tag, Links
+from blog.page_cache import PageCacheMixin, is_warm_request
+from blog.paginator import KeysetPaginator
+from blog.view_counter import view_counter
 from comments.forms import CommentForm
 from haystack.views import SearchView
-from utils.common import cache, get_blog_setting
+from utils.cache import get_tag_versions, get_tagged, set_tagged
+from utils.common import get_blog_setting
 
 logger = logging.getLogger(__name__)
 
@@ -20,7 +24,7 @@ logger = logging.getLogger(__name__)
 # Create your views here.
 
 
-class ArticleListView(generic.ListView):
+class ArticleListView(PageCacheMixin, generic.ListView):
     """
     自定义列表视图
     """
@@ -38,6 +42,8 @@ class ArticleListView(generic.ListView):
     breadcrumbs = [
         ('首页', '/'),
     ]
+    # 键集分页, 不缓存完整的 id 列表, 按页码对应的游标定位当前页
+    keyset_pagination = False
 
     def get_view_cache_key(self):
         return self.request.GET['pages']
@@ -55,6 +61,12 @@ class ArticleListView(generic.ListView):
         """
         raise NotImplementedError()
 
+    def get_queryset_cache_tags(self):
+        """
+        子类可重写.获得queryset缓存依赖的标签, 标签失效时缓存随之失效
+        """
+        return ['article_list']
+
     def get_queryset_data(self):
         """
         子类重写.获取queryset的数据
@@ -63,30 +75,71 @@ class ArticleListView(generic.ListView):
 
     def get_queryset_from_cache(self, cache_key):
         """
-        缓存页面数据
+        缓存页面数据, 只缓存有序的文章 id 列表, 缓存大小不随正文增长
         :param cache_key: 缓存key
-        :return:
+        :return: 文章 id 列表
         """
-        value = cache.get(cache_key)
-        if value:
+        value = get_tagged(cache_key)
+        if value is not None:
             logger.info('get view cache.key:{key}'.format(key=cache_key))
             return value
         else:
-            article_list = self.get_queryset_data()
-            cache.set(cache_key, article_list)
+            versions = get_tag_versions(self.get_queryset_cache_tags())
+            article_ids = list(self.get_queryset_data().values_list('id', flat=True))
+            set_tagged(cache_key, article_ids, versions)
             logger.info('set view cache.key:{key}'.format(key=cache_key))
-            return article_list
+            return article_ids
 
     def get_queryset(self):
         """
         重写默认，从缓存获取数据
-        :return:
+        :return: 文章 id 列表
         """
+        if self.keyset_pagination:
+            return self.get_queryset_data()
         key = self.get_queryset_cache_key()
         value = self.get_queryset_from_cache(key)
         return value
 
+    @staticmethod
+    def get_articles_by_ids(article_ids):
+        """
+        按 id 列表顺序一次查询出文章卡片, 卡片不需要正文
+        :param article_ids: 文章 id 列表
+        :return: 文章列表
+        """
+        articles = Article.objects.cards().in_bulk(article_ids)
+        return [articles[article_id] for article_id in article_ids if article_id in articles]
+
+    def paginate_queryset(self, queryset, page_size):
+        """
+        在 id 列表上分页, 只查询当前页的文章; 键集分页时直接查询当前页的文章卡片, 下一页链接中的游标直接定位
+        """
+        if self.keyset_pagination:
+            paginator = KeysetPaginator(queryset.cards(), page_size, cache_tags=self.get_queryset_cache_tags())
+            try:
+                page = paginator.page(self.page_number, self.request.GET.get('cursor'))
+            except InvalidPage as e:
+                raise Http404('Invalid page ({page_number}): {message}'.format(page_number=self.page_number,
+                                                                               message=e))
+            self.articles = page.object_list
+            return paginator, page, page.object_list, page.has_other_pages()
+        paginator, page, object_list, is_paginated = super().paginate_queryset(queryset, page_size)
+        page.object_list = self.articles = self.get_articles_by_ids(object_list)
+        return paginator, page, page.object_list, is_paginated
+
+    def get_page_cache_tags(self):
+        # 首页等列表页包含侧边栏
+        return super().get_page_cache_tags() + self.get_queryset_cache_tags() + ['sidebar']
+
+    def get_last_modified(self):
+        articles = getattr(self, 'articles', None)
+        return max((article.last_mod_time for article in articles), default=None) if articles else None
+
     def get_context_data(self, **kwargs):
+        if self.get_paginate_by(self.object_list) is None:
+            self.articles = self.get_articles_by_ids(self.object_list)
+            kwargs.setdefault('object_list', self.articles)
         # 判断活跃界面
         if self.request.path == '/':
             kwargs['active_page'] = 'home'
@@ -129,6 +182,7 @@ class PageView(ArticleListView):
     """
     列表页
     """
+    keyset_pagination = True
     breadcrumbs = [
         ('首页', '/'),
         ('列表页', None),
@@ -148,6 +202,7 @@ class PageView(ArticleListView):
 
 class CategoryDetailView(ArticleListView):
     page_type = '分类'
+    keyset_pagination = True
 
     def get_queryset_data(self):
         slug = self.kwargs['category_name']
@@ -155,8 +210,9 @@ class CategoryDetailView(ArticleListView):
 
         category_name = category.name
         self.category_name = category_name
-        category_names = list(map(lambda c: c.name, category.get_sub_category()))
-        article_list = Article.objects.filter(category__name__in=category_names, status='publish')
+        # 包含所有子分类的文章, 子分类按路径前缀作为子查询
+        article_list = Article.objects.filter(category_id__in=category.get_descendants().values('id'),
+                                              status='publish')
         return article_list
 
     def get_queryset_cache_key(self):
@@ -168,6 +224,10 @@ class CategoryDetailView(ArticleListView):
         cache_key = 'category_{category_name}_{page}'.format(category_name=category_name, page=self.page_number)
         return cache_key
 
+    def get_queryset_cache_tags(self):
+        # 分类改名或调整层级都会影响列表
+        return ['article_list', 'category']
+
     def get_context_data(self, **kwargs):
         category_name = self.category_name
         try:
@@ -190,6 +250,7 @@ class AuthorDetailView(ArticleListView):
     作者文章页
     """
     page_type = '作者'
+    keyset_pagination = True
 
     def get_queryset_cache_key(self):
         from uuslug import slugify
@@ -219,6 +280,7 @@ class TagDetailView(ArticleListView):
     标签文章页
     """
     page_type = '标签'
+    keyset_pagination = True
     breadcrumbs = [
         ('首页', '/'),
     ]
@@ -231,6 +293,9 @@ class TagDetailView(ArticleListView):
         cache_key = 'tag_{tag_name}_{page}'.format(tag_name=tag_name, page=self.page_number)
         return cache_key
 
+    def get_queryset_cache_tags(self):
+        return ['article_list', 'tag']
+
     def get_queryset_data(self):
         slug = self.kwargs['tag_name']
         tag = get_object_or_404(Tag, slug=slug)
@@ -252,7 +317,7 @@ class TagDetailView(ArticleListView):
         return super(TagDetailView, self).get_context_data(**kwargs)
 
 
-class ArticleDetailView(DetailView):
+class ArticleDetailView(PageCacheMixin, DetailView):
     """
     文章详情页
     """
@@ -266,7 +331,9 @@ class ArticleDetailView(DetailView):
 
     def get_object(self, queryset=None):
         obj = super(ArticleDetailView, self).get_object(queryset)
-        obj.viewed()
+        self.add_page_cache_tags('article:{id}'.format(id=obj.id), 'user:{id}'.format(id=obj.author_id))
+        if not is_warm_request(self.request):
+            obj.viewed()
         self.object = obj
         return obj
 
@@ -315,10 +382,24 @@ class ArticleDetailView(DetailView):
         kwargs['breadcrumbs'] = breadcrumbs
         kwargs['link_type'] = self.link_type
         kwargs['admin_link'] = admin_link
+        self.article_comments = article_comments
         return super(ArticleDetailView, self).get_context_data(**kwargs)
 
+    def get_last_modified(self):
+        # 文章或评论的最后修改时间
+        comment_times = [comment.last_mod_time for comment in self.article_comments]
+        return max([self.object.last_mod_time] + comment_times)
+
+    def get_page_cache_extra(self):
+        return {'article_id': self.object.id}
+
+    def page_cache_hit(self, request, extra):
+        # 命中缓存时不查询文章, 只增加浏览量
+        if not is_warm_request(request):
+            view_counter.incr(extra['article_id'])
+
     def get_template_names(self):
-        obj = self.get_object()
+        obj = self.object
         if obj.type == 'page':
             template_name = 'blog/article_detail_page.html'
         else:
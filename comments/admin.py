@@ -6,6 +6,7 @@ from django.utils.html import format_html
 from django.utils.translation import ngettext
 
 from comments.models import Comment
+from utils.cache import invalidate_tags
 
 logger = logging.getLogger(__name__)
 
@@ -44,9 +45,23 @@ class CommentAdmin(admin.ModelAdmin):
         return format_html(
             u'<a href="%s">%s</a>' % (link, obj.article.title))
 
+    @staticmethod
+    def update_comments(queryset, **kwargs):
+        """
+        批量更新评论, queryset.update 不发送 post_save 信号, 需要手动失效文章评论列表和侧边栏最近评论的缓存
+        :param queryset: 选中的评论
+        :param kwargs: 更新的字段
+        :return: 更新的数量
+        """
+        # 先取出主键, 更新后按状态过滤的 queryset 可能不再包含这些评论
+        rows = list(queryset.values_list('id', 'article_id'))
+        active = Comment.objects.filter(id__in=[pk for pk, _ in rows]).update(**kwargs)
+        invalidate_tags('sidebar', *{'article:{id}'.format(id=article_id) for _, article_id in rows})
+        return active
+
     @admin.action(description='禁用评论')
     def disable_comments_status(self, request, queryset):
-        active = queryset.update(is_enable=False)
+        active = self.update_comments(queryset, is_enable=False)
         self.message_user(
             request,
             ngettext(
@@ -59,7 +74,7 @@ class CommentAdmin(admin.ModelAdmin):
 
     @admin.action(description='启用评论')
     def enable_comments_status(self, request, queryset):
-        active = queryset.update(is_enable=True)
+        active = self.update_comments(queryset, is_enable=True)
         self.message_user(
             request,
             ngettext(
@@ -5,21 +5,31 @@
 # @File    : comments_tags.py
 # @Software: PyCharm
 from django import template
-from django.template.defaultfilters import stringfilter
 from django.utils.safestring import mark_safe
 
-from utils.common import CommonMarkdown
+from comments.models import Comment
+from utils.common import CommonMarkdown, cache
 
 register = template.Library()
 
+# 评论渲染规则变化后加一, 旧的渲染结果不再使用
+COMMENT_MARKDOWN_VERSION = 2
+
 
 @register.filter()
-@stringfilter
 def comment_markdown(content):
     """
-    评论markdown渲染器
-    :param content: 内容
+    评论markdown渲染器, 评论的渲染结果按评论 id 和修改时间缓存
+    :param content: 评论或内容
     :return: 渲染内容
     """
-    content = CommonMarkdown.get_markdown(content)
+    if isinstance(content, Comment):
+        key = 'comment_markdown_{version}_{id}_{time}'.format(
+            version=COMMENT_MARKDOWN_VERSION, id=content.pk, time=content.last_mod_time.timestamp())
+        value = cache.get(key)
+        if value is None:
+            value = CommonMarkdown.get_markdown(content.body, 'comment')
+            cache.set(key, value, 60 * 60 * 24)
+        return mark_safe(value)
+    content = CommonMarkdown.get_markdown(str(content), 'comment')
     return mark_safe(content)
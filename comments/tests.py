@@ -5,6 +5,7 @@ from django.urls import reverse
 from django.utils import timezone
 
 from blog.models import Category, Article
+from blog.view_counter import view_counter
 from comments.models import Comment
 from utils.comments_utils import send_comment_email
 
@@ -22,6 +23,10 @@ class CommentTest(TestCase):
         value.comment_need_review = True
         value.save()
 
+    def tearDown(self):
+        # 丢弃未写回的浏览量, 不带到其他测试
+        view_counter.buffer.drain()
+
     def update_article_comment_status(self, article):
         comments = article.comment_set.all()
         for comment in comments:
@@ -96,3 +101,95 @@ class CommentTest(TestCase):
         self.assertIsNotNone(comment)
 
         send_comment_email(comment)
+
+    def test_comment_markdown(self):
+        from unittest import mock
+        from comments.templatetags.comments_tags import comment_markdown
+        from utils.common import CommonMarkdown
+        user = get_user_model().objects.create_user(
+            email="markdown@markdown.com",
+            username="markdown",
+            password="123456"
+        )
+        category = Category()
+        category.name = "markdown"
+        category.save()
+        article = Article()
+        article.title = "markdown"
+        article.body = "body"
+        article.author = user
+        article.category = category
+        article.status = "publish"
+        article.save()
+
+        comment = Comment(author=user, article=article, is_enable=True)
+        comment.body = "**bold** `code` [link](javascript:alert(1)) <script>alert(1)</script>"
+        comment.save()
+        with mock.patch.object(CommonMarkdown, 'get_markdown', wraps=CommonMarkdown.get_markdown) as get_markdown:
+            html = comment_markdown(comment)
+            self.assertEqual(comment_markdown(comment), html)
+            self.assertEqual(get_markdown.call_count, 1)
+            # 修改评论后重新渲染
+            comment.body = "# changed"
+            comment.save()
+            self.assertIn('# changed', comment_markdown(comment))
+            self.assertEqual(get_markdown.call_count, 2)
+        self.assertIn('<strong>bold</strong>', html)
+        self.assertIn('&lt;script&gt;', html)
+        self.assertNotIn('javascript', html)
+
+        # 实体编码、空白和控制字符混淆的协议同样去掉, 评论不支持折叠块
+        for body in ['[a](javascript&#58;alert(1))', '[a](&#106;avascript:alert(1))',
+                     '[a](java&#x09;script:alert(1))', '[a](\x01javascript:alert(1))', '[a](http://[::1)']:
+            self.assertNotIn('href', CommonMarkdown.get_markdown(body, 'comment'), body)
+        self.assertIn('href="https://example.com/?a=1&amp;b=2"',
+                      CommonMarkdown.get_markdown('[a](https://example.com/?a=1&b=2)', 'comment'))
+        self.assertNotIn('<details', CommonMarkdown.get_markdown('details: fold', 'comment'))
+
+    def test_cached_page_comments(self):
+        from django.core.cache import cache
+        cache.clear()
+        author = get_user_model().objects.create_user(
+            email="cached@cached.com",
+            username="cached",
+            password="123456"
+        )
+        category = Category()
+        category.name = "cached"
+        category.save()
+        article = Article()
+        article.title = "cached"
+        article.body = "body"
+        article.author = author
+        article.category = category
+        article.status = "publish"
+        article.save()
+        comment_url = reverse('comments:postcomment', kwargs={'article_id': article.id})
+
+        # 匿名访客共享缓存的页面, 页面中没有评论表单和 csrf token, 匿名提交跳转到登录页
+        clients = [Client(enforce_csrf_checks=True) for _ in range(2)]
+        for client in clients:
+            response = client.get(article.get_absolute_url())
+            self.assertEqual(response.status_code, 200)
+            self.assertNotContains(response, 'csrfmiddlewaretoken')
+            self.assertNotIn('csrftoken', response.cookies)
+        response = Client().post(comment_url, {'body': 'anonymous'})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.url.startswith('/login/'))
+
+        # 两个访客登录后各自用自己的 token 发表评论
+        for i, client in enumerate(clients):
+            get_user_model().objects.create_user(
+                email="visitor{i}@cached.com".format(i=i),
+                username="visitor{i}".format(i=i),
+                password="123456"
+            )
+            client.login(username="visitor{i}".format(i=i), password="123456")
+            response = client.get(article.get_absolute_url())
+            self.assertContains(response, 'csrfmiddlewaretoken')
+            response = client.post(comment_url, {
+                'body': 'comment {i}'.format(i=i),
+                'csrfmiddlewaretoken': client.cookies['csrftoken'].value,
+            })
+            self.assertEqual(response.status_code, 302)
+        self.assertEqual(Comment.objects.filter(article=article).count(), 2)
@@ -1,4 +1,5 @@
 # Create your views here.
+from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import ValidationError
 from django.http import HttpResponseRedirect
 from django.shortcuts import get_object_or_404
@@ -11,9 +12,9 @@ from comments.forms import CommentForm
 from comments.models import Comment
 
 
-class CommentPostView(FormView):
+class CommentPostView(LoginRequiredMixin, FormView):
     """
-    评论视图
+    评论视图, 评论作者必须是登录用户, 匿名请求跳转到登录页
     """
     form_class = CommentForm
     template_name = 'blog/article_detail.html'
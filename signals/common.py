@@ -1,6 +1,7 @@
 import _thread
 import logging
 
+from django.contrib.sites.models import Site
 from django.core.mail import EmailMultiAlternatives
 from django.db.models.signals import post_save
 from django.dispatch import receiver, Signal
@@ -8,12 +9,14 @@ from django.dispatch import receiver, Signal
 from comments.models import Comment
 from mysite import settings
 from utils.comments_utils import send_comment_email
-from utils.common import get_current_site, cache, expire_view_cache, delete_view_cache
+from utils.cache import invalidate_tags
+from utils.common import get_current_site, expire_view_cache, delete_view_cache
 from utils.spider_notify import SpiderNotify
 from websys.models import EmailLog
 
 logger = logging.getLogger(__name__)
 send_email_signal = Signal(['subject', 'message', 'recipient_list'])
+LOGIN_UPDATE_FIELDS = {'last_login', 'last_login_IP'}
 
 
 @receiver(send_email_signal)
@@ -56,19 +59,23 @@ def model_post_save_callback(sender, instance, created, raw, using, update_field
     post 信号处理
     :return:
     """
-    clear_cache = False
+    cache_tags = []
     if isinstance(instance, EmailLog):
         return
+    # 登录只更新登录时间和 IP, 页面上没有展示, 不需要通知搜索引擎或失效缓存
+    if update_fields and set(update_fields) <= LOGIN_UPDATE_FIELDS:
+        return
     if 'get_full_url' in dir(instance):
-        is_update_views = update_fields == {'views'}
-        if not settings.TESTING and not is_update_views:
+        if not settings.TESTING:
             try:
                 notify_url = instance.get_full_url()
                 SpiderNotify.baidu_notify([notify_url])
             except Exception as e:
                 logger.error("notify spider", e)
-        if not is_update_views:
-            clear_cache = True
+    if 'get_cache_tags' in dir(instance):
+        cache_tags.extend(instance.get_cache_tags())
+    if isinstance(instance, Site):
+        cache_tags.append('site')
     if isinstance(instance, Comment):
         if instance.is_enable:
             path = instance.article.get_absolute_url()
@@ -81,14 +88,12 @@ def model_post_save_callback(sender, instance, created, raw, using, update_field
                 servername=site,
                 port=80,
                 key_prefix='blog_detail')
-            if cache.get('seo_processor'):
-                cache.delete('seo_processor')
-            comment_cache_key = 'article_comments_{id}'.format(id=instance.article.id)
-            cache.delete(comment_cache_key)
+            # 文章评论列表和侧边栏最近评论
+            cache_tags.extend(['article:{id}'.format(id=instance.article.id), 'sidebar'])
 
             delete_view_cache('article_comments', [str(instance.article.pk)])
 
             _thread.start_new_thread(send_comment_email, (instance,))
 
-    if clear_cache:
-        cache.clear()
+    if cache_tags:
+        invalidate_tags(*cache_tags)
@@ -10,12 +10,15 @@ document.addEventListener("DOMContentLoaded", function () {
         tocDrawer.classList.add('hidden');
     });
 
-    renderMathInElement(document.body, {
-        delimiters: [
-            {left: '$$', right: '$$', display: true},
-            {left: '$', right: '$', display: false}
-        ]
-    })
+    // 服务端只渲染 $`...`$ 和 math 代码块, $...$ 仍由 auto-render 在客户端渲染, 脚本加载失败时不影响目录
+    if (typeof renderMathInElement === 'function') {
+        renderMathInElement(document.body, {
+            delimiters: [
+                {left: '$$', right: '$$', display: true},
+                {left: '$', right: '$', display: false}
+            ]
+        })
+    }
 
     function redirectPageCenter(anchor) {
         anchor.addEventListener('click', function (e) {
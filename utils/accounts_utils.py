@@ -16,6 +16,7 @@ from django.urls import reverse
 from accounts.models import OAuthConfig
 from accounts.oauth_manager import BaseOAuthManager
 from mysite import settings
+from utils.cache import near_cache
 from utils.common import get_current_site, send_email, get_sha256, cache, cache_decorator
 
 logger = logging.getLogger(__name__)
@@ -115,27 +116,40 @@ def verify(email: str, code: str):
 _code_ttl = timedelta(minutes=5)
 
 
+def get_code_key(email: str) -> str:
+    """验证码的缓存键, 带前缀以免与其他缓存冲突, 统计时归为 email_code 一类"""
+    return 'email_code:{email}'.format(email=email)
+
+
 def set_code(email: str, code: str):
     """设置code"""
-    cache.set(email, code, _code_ttl.seconds)
+    cache.set(get_code_key(email), code, _code_ttl.seconds)
 
 
 def get_code(email: str) -> typing.Optional[str]:
     """获取code"""
-    return cache.get(email)
+    return cache.get(get_code_key(email))
+
+
+@cache_decorator(expiration=100 * 60, tags=['oauth'])
+def get_oauth_app_codes():
+    """
+    返回启用的第三方应用代码
+    """
+    configs = OAuthConfig.objects.filter(is_enable=True).select_related('oauth_app')
+    return [config.oauth_app.code for config in configs]
 
 
-@cache_decorator(expiration=100 * 60)
 def get_oauth_apps():
     """
     返回一个可使用的第三方列表
     """
-    configs = OAuthConfig.objects.filter(is_enable=True).all()
-    if not configs:
+    # manager 会保存用户的 access_token, 只缓存应用代码, 每次调用创建新的 manager
+    config_apps = near_cache.get_or_set('oauth_app_codes', get_oauth_app_codes, ['oauth'])
+    if not config_apps:
         return []
-    config_apps = [config.oauth_app.code for config in configs]
     applications = BaseOAuthManager.__subclasses__()
-    apps = [application() for application in applications if application().CODE in config_apps]
+    apps = [application() for application in applications if application.CODE in config_apps]
     return apps
 
 
@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2024/12/22 20:40
+# @Author  : Joker
+# @File    : cache.py
+# @Software: PyCharm
+import logging
+import os
+import pickle
+import re
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from hashlib import sha256
+
+from django.core.cache import cache as django_cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import connections, models
+
+logger = logging.getLogger(__name__)
+
+# 缓存标签的版本号键前缀
+CACHE_TAG_PREFIX = 'cache_tag:'
+# 各进程缓存统计快照所在槽位的键前缀, 以及已分配的槽位数
+CACHE_METRICS_PREFIX = 'cache_metrics:'
+CACHE_METRICS_SLOTS = 'cache_metrics_slots'
+CACHE_METRICS_SORT_FIELDS = ['hits', 'misses', 'hit_rate', 'stale', 'sets', 'deletes', 'bytes', 'avg_bytes',
+                             'max_bytes', 'avg_ms', 'avg_render_ms', 'saved_ms']
+# 以下划线分隔参数的缓存键前缀, 如 category_<分类名>_<页码>
+KEY_FAMILY_PREFIXES = ['article_comments_', 'comment_markdown_', 'footer_links_', 'blog_page_', 'category_',
+                       'author_', 'tag_']
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+# 不带参数的固定缓存键, 如 seo_processor, 直接作为类别; 其余无法识别的键归入 other, 避免类别数随键无限增长
+FIXED_KEY_RE = re.compile(r'^[a-z][a-z0-9_]*$')
+
+
+class LRUCache:
+    """
+    线程安全的进程内 LRU 缓存
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def get_key_family(key):
+    """
+    缓存键所属的类别, 去掉键中的 id、页码、哈希等参数
+    :param key: 缓存键
+    :return: 类别
+    """
+    key = str(key)
+    suffix = next((suffix for suffix in (':lock', ':refresh') if key.endswith(suffix)), '')
+    if key.startswith(('cache_func:', 'fragment:')):
+        return ':'.join(key.split(':')[:2]) + suffix
+    if ':' in key:
+        return key.split(':', 1)[0] + suffix
+    if SHA256_RE.match(key):
+        return 'sha256'
+    for prefix in KEY_FAMILY_PREFIXES:
+        if key.startswith(prefix):
+            return prefix.rstrip('_')
+    if FIXED_KEY_RE.match(key):
+        return key
+    return 'other'
+
+
+class CacheMetrics:
+    """
+    按缓存键类别统计命中、未命中、写入、删除次数, 写入大小和耗时, 片段缓存另外统计渲染耗时和命中节省的耗时
+    cache_decorator 按函数记录在 func:<函数名> 类别下, 命中过期旧值计入 stale
+    统计保存在进程内, 每隔 flush_interval 秒把快照写入缓存中本进程的槽位, 管理命令和后台页面汇总所有槽位的快照
+    写入大小需要再序列化一次, 每个类别每 size_sample_rate 次写入只测量一次, 总大小按测量结果估算
+    """
+    FIELDS = ['hits', 'misses', 'stale', 'sets', 'deletes', 'sized', 'bytes', 'max_bytes', 'seconds', 'renders', 'render_seconds',
+              'saved_seconds']
+
+    def __init__(self, flush_interval=30, size_sample_rate=10, snapshot_timeout=60 * 60 * 24):
+        self.flush_interval = flush_interval
+        self.size_sample_rate = size_sample_rate
+        # 进程退出后快照和槽位在过期后释放, 由新进程复用
+        self.snapshot_timeout = snapshot_timeout
+        self._families = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._slot = None
+
+    def should_measure(self, family):
+        """
+        本次写入是否测量大小, 每个类别的第一次写入总是测量
+        """
+        with self._lock:
+            stats = self._families.get(family)
+            return stats is None or stats['sets'] % self.size_sample_rate == 0
+
+    def record(self, family, seconds, hits=0, misses=0, stale=0, sets=0, deletes=0, size=None, render_seconds=0,
+               saved_seconds=0):
+        with self._lock:
+            stats = self._families.setdefault(family, dict.fromkeys(self.FIELDS, 0))
+            stats['hits'] += hits
+            stats['misses'] += misses
+            stats['stale'] += stale
+            stats['sets'] += sets
+            stats['deletes'] += deletes
+            if size is not None:
+                stats['sized'] += 1
+                stats['bytes'] += size
+                stats['max_bytes'] = max(stats['max_bytes'], size)
+            stats['seconds'] += seconds
+            stats['renders'] += int(bool(render_seconds))
+            stats['render_seconds'] += render_seconds
+            stats['saved_seconds'] += saved_seconds
+            flush = time.monotonic() - self._last_flush > self.flush_interval
+            if flush:
+                self._last_flush = time.monotonic()
+        if flush:
+            self.flush()
+
+    def snapshot(self):
+        with self._lock:
+            return {family: dict(stats) for family, stats in self._families.items()}
+
+    @staticmethod
+    def get_worker():
+        return '{host}:{pid}'.format(host=socket.gethostname(), pid=os.getpid())
+
+    @staticmethod
+    def get_slot_keys():
+        return [CACHE_METRICS_PREFIX + str(slot) for slot in range(django_cache.get(CACHE_METRICS_SLOTS) or 0)]
+
+    def claim_slot(self, entry):
+        """
+        用 add 原子地占用第一个空闲槽位并写入快照, 没有空闲槽位时用 incr 分配新槽位
+        :param entry: 快照
+        :return: 槽位键
+        """
+        for key in self.get_slot_keys():
+            if django_cache.add(key, entry, self.snapshot_timeout):
+                return key
+        django_cache.add(CACHE_METRICS_SLOTS, 0, None)
+        key = CACHE_METRICS_PREFIX + str(django_cache.incr(CACHE_METRICS_SLOTS) - 1)
+        django_cache.set(key, entry, self.snapshot_timeout)
+        return key
+
+    def flush(self):
+        """
+        把本进程的统计写入缓存, 直接使用 django 缓存, 不计入统计
+        槽位过期或被清空后重新占用, 各进程只写自己的槽位, 不需要读改写共享的进程列表
+        """
+        entry = {'worker': self.get_worker(), 'families': self.snapshot()}
+        current = django_cache.get(self._slot) if self._slot else None
+        if current and current['worker'] == entry['worker']:
+            django_cache.set(self._slot, entry, self.snapshot_timeout)
+        else:
+            self._slot = self.claim_slot(entry)
+
+    def collect(self):
+        """
+        汇总所有进程的统计
+        :return: {类别: 统计}
+        """
+        self.flush()
+        result = {}
+        for entry in django_cache.get_many(self.get_slot_keys()).values():
+            for family, stats in entry['families'].items():
+                total = result.setdefault(family, dict.fromkeys(self.FIELDS, 0))
+                for field in self.FIELDS:
+                    if field == 'max_bytes':
+                        total[field] = max(total[field], stats.get(field, 0))
+                    else:
+                        total[field] += stats.get(field, 0)
+        return result
+
+    def report(self, sort='misses'):
+        """
+        汇总统计并计算命中率、平均大小和平均耗时
+        :param sort: 排序字段, 从大到小
+        :return: [{类别及统计}, ...]
+        """
+        rows = []
+        for family, stats in self.collect().items():
+            reads = stats['hits'] + stats['misses']
+            ops = reads + stats['sets'] + stats['deletes']
+            rows.append(dict(
+                stats,
+                family=family,
+                hit_rate=stats['hits'] / reads if reads else 0,
+                # 按测量过的写入估算总大小
+                bytes=stats['bytes'] * stats['sets'] // stats['sized'] if stats['sized'] else 0,
+                avg_bytes=stats['bytes'] // stats['sized'] if stats['sized'] else 0,
+                avg_ms=stats['seconds'] * 1000 / ops if ops else 0,
+                avg_render_ms=stats['render_seconds'] * 1000 / stats['renders'] if stats['renders'] else 0,
+                saved_ms=stats['saved_seconds'] * 1000,
+            ))
+        rows.sort(key=lambda row: row[sort], reverse=True)
+        return rows
+
+    def reset(self):
+        """
+        清空所有进程的统计, 其他进程的本地统计在下次写入时仍会带上
+        """
+        with self._lock:
+            self._families.clear()
+        django_cache.delete_many(self.get_slot_keys() + [CACHE_METRICS_SLOTS])
+        self._slot = None
+
+
+cache_metrics = CacheMetrics()
+
+
+def get_payload_size(value):
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 0
+
+
+class InstrumentedCache:
+    """
+    记录统计的缓存包装, 其余方法直接转发给 django 缓存
+    """
+    _missing = object()
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
+
+    def get(self, key, default=None, **kwargs):
+        start = time.perf_counter()
+        value = self._backend.get(key, self._missing, **kwargs)
+        hit = value is not self._missing
+        cache_metrics.record(get_key_family(key), time.perf_counter() - start, hits=int(hit), misses=int(not hit))
+        return value if hit else default
+
+    def get_many(self, keys, **kwargs):
+        keys = list(keys)
+        start = time.perf_counter()
+        values = self._backend.get_many(keys, **kwargs)
+        seconds = time.perf_counter() - start
+        for key in keys:
+            cache_metrics.record(get_key_family(key), seconds / len(keys), hits=int(key in values),
+                                 misses=int(key not in values))
+        return values
+
+    @staticmethod
+    def get_sampled_size(family, value):
+        return get_payload_size(value) if cache_metrics.should_measure(family) else None
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, **kwargs):
+        family = get_key_family(key)
+        start = time.perf_counter()
+        result = self._backend.set(key, value, timeout, **kwargs)
+        seconds = time.perf_counter() - start
+        cache_metrics.record(family, seconds, sets=1, size=self.get_sampled_size(family, value))
+        return result
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, **kwargs):
+        family = get_key_family(key)
+        start = time.perf_counter()
+        result = self._backend.add(key, value, timeout, **kwargs)
+        seconds = time.perf_counter() - start
+        cache_metrics.record(family, seconds, sets=int(bool(result)),
+                             size=self.get_sampled_size(family, value) if result else None)
+        return result
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, **kwargs):
+        start = time.perf_counter()
+        result = self._backend.set_many(data, timeout, **kwargs)
+        seconds = time.perf_counter() - start
+        for key, value in data.items():
+            family = get_key_family(key)
+            cache_metrics.record(family, seconds / len(data), sets=1, size=self.get_sampled_size(family, value))
+        return result
+
+    def delete(self, key, **kwargs):
+        start = time.perf_counter()
+        result = self._backend.delete(key, **kwargs)
+        cache_metrics.record(get_key_family(key), time.perf_counter() - start, deletes=1)
+        return result
+
+    def delete_many(self, keys, **kwargs):
+        keys = list(keys)
+        start = time.perf_counter()
+        result = self._backend.delete_many(keys, **kwargs)
+        seconds = time.perf_counter() - start
+        for key in keys:
+            cache_metrics.record(get_key_family(key), seconds / len(keys), deletes=1)
+        return result
+
+
+cache = InstrumentedCache(django_cache)
+
+
+def get_tag_key(tag):
+    return CACHE_TAG_PREFIX + tag
+
+
+def get_tag_versions(tags):
+    """
+    标签当前的版本号, 不存在的标签生成新版本号
+    :param tags: 标签列表
+    :return: {标签: 版本号}
+    """
+    tag_keys = [get_tag_key(tag) for tag in tags]
+    versions = cache.get_many(tag_keys)
+    missing = {tag_key: uuid.uuid4().hex for tag_key in tag_keys if tag_key not in versions}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return {tag: versions[get_tag_key(tag)] for tag in tags}
+
+
+def make_fragment_key(name, tags, vary_on=()):
+    """
+    生成模板片段缓存键, 键中包含标签的版本号, 标签失效后键随之改变, 旧片段不再被读取, 过期后自动清除
+    :param name: 片段名
+    :param tags: 片段依赖的标签
+    :param vary_on: 区分片段的变量, 如当前页面
+    :return: 缓存键
+    """
+    versions = get_tag_versions(tags)
+    parts = ['{tag}={version}'.format(tag=tag, version=versions[tag]) for tag in sorted(versions)]
+    parts.extend(str(value) for value in vary_on)
+    digest = sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+    return 'fragment:{name}:{digest}'.format(name=name, digest=digest)
+
+
+def get_tagged_stale(key):
+    """
+    读取带标签的缓存, 标签失效后仍返回旧值, 由调用方决定是否使用
+    :param key: 缓存键
+    :return: (缓存值, 标签是否有效), 不存在时返回 None
+    """
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    versions, value = entry
+    current = cache.get_many([get_tag_key(tag) for tag in versions])
+    valid = all(current.get(get_tag_key(tag)) == version for tag, version in versions.items())
+    return value, valid
+
+
+def get_tagged(key, default=None):
+    """
+    读取带标签的缓存, 任一标签在写入后失效过则视为未命中
+    :param key: 缓存键
+    :param default: 未命中时的返回值
+    :return: 缓存值
+    """
+    entry = get_tagged_stale(key)
+    if entry is None or not entry[1]:
+        return default
+    return entry[0]
+
+
+def set_tagged(key, value, tags, timeout=DEFAULT_TIMEOUT):
+    """
+    写入缓存并记录所属标签的版本号
+    版本号应在计算缓存值之前用 get_tag_versions 读取, 计算期间标签失效时缓存值随之失效, 不会把旧值记在新版本下
+    :param key: 缓存键
+    :param value: 缓存值
+    :param tags: 计算前读取的 {标签: 版本号}; 也可以是标签列表, 写入时读取当前版本号, 只用于不依赖标签数据的值
+    :param timeout: 过期时间
+    """
+    versions = tags if isinstance(tags, dict) else get_tag_versions(tags)
+    cache.set(key, (versions, value), timeout)
+
+
+def invalidate_tags(*tags):
+    """
+    使标签下的所有缓存失效, 只更新标签的版本号, 缓存值在过期或覆盖前不会被读取
+    :param tags: 标签
+    """
+    if tags:
+        cache.set_many({get_tag_key(tag): uuid.uuid4().hex for tag in tags}, None)
+        near_cache.discard(*tags)
+
+
+# 记录当前线程(gevent 下为协程)处理的请求是否用到了软过期的旧值
+_stale_state = threading.local()
+
+
+def reset_stale_served():
+    _stale_state.served = False
+
+
+def mark_stale_served():
+    """
+    返回软过期的旧值时调用, 整页缓存不保存用到旧值的页面
+    """
+    _stale_state.served = True
+
+
+def was_stale_served():
+    return getattr(_stale_state, 'served', False)
+
+
+def refresh_in_background(key, func, lock_timeout=60):
+    """
+    在后台线程中刷新缓存, 同一个键同时只有一个线程刷新; gevent 打补丁后线程即协程
+    :param key: 缓存键, 用于加锁
+    :param func: 刷新函数
+    :param lock_timeout: 锁超时时间
+    :return: 是否启动了刷新
+    """
+    lock_key = key + ':refresh'
+    if not cache.add(lock_key, 1, lock_timeout):
+        return False
+
+    def run():
+        try:
+            func()
+        except Exception as e:
+            logger.error('refresh cache in background failed:{key} {error}'.format(key=key, error=e))
+        finally:
+            cache.delete(lock_key)
+            # 后台线程的数据库连接不会随请求结束关闭
+            connections.close_all()
+
+    threading.Thread(target=run, name='refresh-' + key, daemon=True).start()
+    return True
+
+
+class NearCache:
+    """
+    进程内近端缓存, 放在 redis 前面缓存每个请求都要读取的全局数据
+    ttl 内直接返回进程内的值, 不访问 redis; 过期后用一次 get_many 比对标签版本号,
+    标签未失效则续期, 否则重新加载. 其他进程的失效最多延迟 ttl 秒生效, 本进程立即生效
+    """
+    def __init__(self, ttl=5):
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get_or_set(self, key, func, tags):
+        """
+        :param key: 缓存键
+        :param func: 加载函数, 通常读取 redis 中带标签的缓存
+        :param tags: 缓存标签列表
+        :return: 缓存值
+        """
+        now = time.monotonic()
+        entry = self._data.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[2]
+        tag_keys = [get_tag_key(tag) for tag in tags]
+        versions = cache.get_many(tag_keys)
+        if entry is not None and entry[1] == versions:
+            value = entry[2]
+        else:
+            # 先取版本号再加载, 加载期间发生的失效会在下次比对时发现
+            value = func()
+        with self._lock:
+            self._data[key] = (now + self.ttl, versions, value, tags)
+        return value
+
+    def discard(self, *tags):
+        """
+        丢弃依赖这些标签的本地缓存
+        """
+        tags = set(tags)
+        with self._lock:
+            for key in [key for key, entry in self._data.items() if tags.intersection(entry[3])]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+near_cache = NearCache()
+
+
+def _key_part(value):
+    """
+    参数在缓存键中的表示, 模型实例取模型名、主键和修改时间, 其余取 repr
+    """
+    if isinstance(value, models.Model):
+        last_mod_time = getattr(value, 'last_mod_time', None)
+        return '{label}:{pk}:{mod}'.format(
+            label=value._meta.label_lower, pk=value.pk,
+            mod=last_mod_time.timestamp() if last_mod_time else '')
+    return repr(value)
+
+
+def make_cache_key(func, args, kwargs):
+    """
+    生成函数缓存键, 由函数限定名和参数组成, 不含内存地址, 各进程和重启后保持一致
+    :param func: 被缓存的函数
+    :param args: 位置参数
+    :param kwargs: 关键字参数
+    :return: 缓存键
+    """
+    parts = [_key_part(arg) for arg in args]
+    parts.extend('{name}={value}'.format(name=name, value=_key_part(value)) for name, value in sorted(kwargs.items()))
+    digest = sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+    return 'cache_func:{module}.{name}:{digest}'.format(module=func.__module__, name=func.__qualname__, digest=digest)
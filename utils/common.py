@@ -5,34 +5,56 @@
 # @File    : common.py
 # @Software: PyCharm
 import functools
+import html
 import logging
+import math
+import re
+import threading
+import time
+from collections import namedtuple
 from hashlib import sha256
+from html.parser import HTMLParser
 
 import markdown
+from django.conf import settings
 from django.contrib.sites.models import Site
-from django.core.cache import cache
+from django.utils.html import strip_tags
 from markdown.extensions.smarty import SmartyExtension
+from markdown.extensions.toc import nest_toc_tokens
 from markdown_extensions.emoji.extension import EmojiExtension
-from markdown_katex.extension import KatexExtension
+from markdown_katex.extension import KATEX_STYLES
 
+from utils.cache import (LRUCache, cache, cache_metrics, get_tag_versions, get_tagged, make_cache_key,
+                         mark_stale_served, near_cache, set_tagged)
 from utils.extensions import *
 
 logger = logging.getLogger(__name__)
 
+# 缓存缺失时等待其他请求计算结果的最长时间(秒)
+SINGLE_FLIGHT_WAIT = 3
+
 
 def get_blog_setting():
     """
-    获取博客网站的设置
+    获取博客网站的设置, 每个请求会多次读取, 先查进程内近端缓存
+    """
+    return near_cache.get_or_set('x_blog_setting', _load_blog_setting, ['settings'])
+
+
+def _load_blog_setting():
+    """
+    从缓存或数据库加载博客网站的设置
     """
     # 先从缓存中找
     # 如果存在直接返回
     # 如果不存在从数据库中获取，如数据库中没有, 则新增一个标准配置
     # 缓存并返回数据
-    value = cache.get('x_blog_setting')
+    value = get_tagged('x_blog_setting')
     if value:
         return value
     else:
         from blog.models import BlogSettings
+        versions = get_tag_versions(['settings'])
         if not BlogSettings.objects.count():
             setting = BlogSettings()
             setting.site_name = 'XBlog'
@@ -51,7 +73,7 @@ def get_blog_setting():
             setting.save()
         value = BlogSettings.objects.first()
         logger.info('set cache x_blog_setting')
-        cache.set('x_blog_setting', value)
+        set_tagged('x_blog_setting', value, versions)
         return value
 
 
@@ -65,86 +87,431 @@ def get_sha256(string: str) -> str:
     return m.hexdigest()
 
 
-def cache_decorator(expiration=3 * 60):
+# 中日韩文字按单字计数和截断
+CJK_CHARS = r'\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+CJK_CHAR_RE = re.compile(r'[{cjk}]'.format(cjk=CJK_CHARS))
+TEXT_TOKEN_RE = re.compile(r'[{cjk}]|[^\s{cjk}]+'.format(cjk=CJK_CHARS))
+WORD_RE = re.compile(r"[^\W_]+(?:['’-][^\W_]+)*")
+HTML_NON_TEXT_RE = re.compile(r'<(style|script)\b.*?</\1>', re.S | re.I)
+# 阅读速度: 中文每分钟 300 字, 英文每分钟 200 词
+CJK_CHARS_PER_MINUTE = 300
+WORDS_PER_MINUTE = 200
+
+TextMeta = namedtuple('TextMeta', ['excerpt', 'word_count', 'char_count', 'reading_time'])
+
+
+def get_text_meta(value: str, excerpt_length: int) -> TextMeta:
+    """
+    从渲染后的 html 中提取纯文本, 计算摘要、字数、字符数和阅读时间, 中日韩文字按单字计算
+    :param value: html
+    :param excerpt_length: 摘要长度, 单位为字(词)
+    :return: TextMeta
+    """
+    text = ' '.join(html.unescape(strip_tags(HTML_NON_TEXT_RE.sub('', value))).split())
+    tokens = list(TEXT_TOKEN_RE.finditer(text))
+    if len(tokens) > excerpt_length:
+        excerpt = text[:tokens[excerpt_length - 1].end()] + ' …'
+    else:
+        excerpt = text
+    cjk_count = len(CJK_CHAR_RE.findall(text))
+    word_count = len(WORD_RE.findall(CJK_CHAR_RE.sub(' ', text)))
+    reading_time = math.ceil(cjk_count / CJK_CHARS_PER_MINUTE + word_count / WORDS_PER_MINUTE)
+    return TextMeta(excerpt, cjk_count + word_count, len(text.replace(' ', '')), reading_time)
+
+
+# KaTeX auto-render 跳过的标签, 以及服务端已渲染的公式, 其中的 $ 不会在客户端渲染
+CLIENT_MATH_IGNORED_TAGS = {'script', 'noscript', 'style', 'textarea', 'pre', 'code', 'option'}
+CLIENT_MATH_RE = re.compile(r'\$\$.+?\$\$|\$[^$]+\$', re.S)
+
+
+class ClientMathParser(HTMLParser):
+    """
+    查找需要 auto-render 在客户端渲染的 $...$ 和 $$...$$ 公式
+    """
+    def __init__(self):
+        super().__init__()
+        self.found = False
+        self.skip_tag = None
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if self.skip_tag:
+            if tag == self.skip_tag:
+                self.skip_depth += 1
+        elif tag in CLIENT_MATH_IGNORED_TAGS or 'katex' in (dict(attrs).get('class') or '').split():
+            self.skip_tag, self.skip_depth = tag, 1
+
+    def handle_endtag(self, tag):
+        if self.skip_tag == tag:
+            self.skip_depth -= 1
+            if not self.skip_depth:
+                self.skip_tag = None
+
+    def handle_data(self, data):
+        if not self.skip_tag and CLIENT_MATH_RE.search(data):
+            self.found = True
+
+
+def has_client_math(value: str) -> bool:
+    """
+    渲染后的 html 中是否还有需要在客户端渲染的公式, 服务端只渲染 $`...`$ 和 math 代码块
+    :param value: html
+    :return: 是否需要加载 KaTeX 脚本
+    """
+    if '$' not in value:
+        return False
+    parser = ClientMathParser()
+    parser.feed(value)
+    parser.close()
+    return parser.found
+
+
+def cache_decorator(expiration=3 * 60, tags=None, stale=None, lock_timeout=30):
     """
     缓存装饰器, 将函数结果缓存
+    过期后的 stale 时间内继续返回旧值, 只由拿到锁的一个请求重新计算; 缓存缺失时其余请求等待该请求的结果
+    :param expiration: 过期时间
+    :param tags: 缓存标签列表, 或根据函数参数返回标签列表的函数, 标签失效后缓存随之失效
+    :param stale: 过期后仍可返回旧值的时间, 默认与过期时间相同
+    :param lock_timeout: 重新计算锁的超时时间
     """
+    stale_time = expiration if stale is None else stale
+
     def decorator(func):
+        name = '{module}.{name}'.format(module=func.__module__, name=func.__qualname__)
+        # 按函数统计命中、过期和缺失, 与其他缓存统计一起汇总
+        family = 'func:' + name
+
+        def get_entry(key, tag_list):
+            return get_tagged(key) if tag_list else cache.get(key)
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            # 获取对象的字符串表示
-            unique_str = repr((func, args, kwargs))
-            # key 为对象字符串表示哈希 256 加密后的 16 进制字符串
-            key = get_sha256(unique_str)
-            value = cache.get(key)
-            if value is not None:
-                if str(value) == '__default_cache_value__':
-                    return None
-                else:
+            key = make_cache_key(func, args, kwargs)
+            lock_key = key + ':lock'
+            tag_list = tags(*args, **kwargs) if callable(tags) else tags
+            # 缓存值为 (新鲜截止时间, 函数结果), 函数返回 None 也能缓存
+            entry = get_entry(key, tag_list)
+            if entry is not None:
+                fresh_until, value = entry
+                if time.time() < fresh_until:
+                    cache_metrics.record(family, 0, hits=1)
+                    return value
+                cache_metrics.record(family, 0, stale=1)
+                acquired = cache.add(lock_key, 1, lock_timeout)
+                if not acquired:
+                    # 其他请求正在重新计算, 先返回旧值
+                    mark_stale_served()
                     return value
             else:
-                logger.debug('cache_decorator set cache:%s key:%s' % (func.__name__, key))
+                cache_metrics.record(family, 0, misses=1)
+                acquired = cache.add(lock_key, 1, lock_timeout)
+                if not acquired:
+                    deadline = time.time() + SINGLE_FLIGHT_WAIT
+                    while time.time() < deadline:
+                        time.sleep(0.05)
+                        entry = get_entry(key, tag_list)
+                        if entry is not None:
+                            return entry[1]
+                    # 等待超时后自行计算, 锁仍属于正在计算的请求, 不能释放
+                    logger.warning('cache_decorator wait timeout:%s key:%s' % (name, key))
+            try:
+                logger.debug('cache_decorator set cache:%s key:%s' % (name, key))
+                versions = get_tag_versions(tag_list) if tag_list else None
                 value = func(*args, **kwargs)
-                if value is None:
-                    cache.set(key, '__default_cache_value__', expiration)
+                entry = (time.time() + expiration, value)
+                if tag_list:
+                    set_tagged(key, entry, versions, expiration + stale_time)
                 else:
-                    cache.set(key, value, expiration)
-                return value
+                    cache.set(key, entry, expiration + stale_time)
+            finally:
+                if acquired:
+                    cache.delete(lock_key)
+            return value
         return wrapper
     return decorator
 
 
-@cache_decorator()
 def get_current_site():
     """
     根据站点框架获取当前网站
     """
-    site = Site.objects.get_current()
-    return site
+    return near_cache.get_or_set('current_site', _load_current_site, ['site'])
+
+
+def _load_current_site():
+    # 站点框架的 SITE_CACHE 只在修改站点的进程中清除, 这里直接查询
+    return Site.objects.get(pk=settings.SITE_ID)
+
+
+# 分块渲染时识别顶层块的正则
+BLOCK_FENCE_RE = re.compile(r'^(`{3,}|~{3,})')
+BLOCK_ALERT_RE = re.compile(AlertBlockProcessor.RE_FENCE_START)
+BLOCK_HTML_RE = re.compile(r'^<[a-zA-Z!?/]')
+BLOCK_FOOTNOTE_RE = re.compile(r'^\[\^[^\]]+\][ ]?:')
+BLOCK_DEFINITION_RE = re.compile(r'^(?: {0,3}\[[^\]]+\]|\*\[[^\]]+\])[ ]?:')
+BLOCK_ID_RE = re.compile(r'\sid="([^"]+)"')
 
 
 class CommonMarkdown:
     """
     通用 markdown 类, 用于处理 markdown 内容
     """
+    # 每个线程(gevent 下为协程)持有各渲染场景的 markdown 引擎, 渲染完成后 reset 复用
+    _engines = threading.local()
+    # 分块渲染结果, 以块内容哈希为键; 进程内 LRU 在前, Django 缓存在后, 各进程共享同一份渲染结果
+    _block_cache = LRUCache(maxsize=2048)
+    block_cache_timeout = 60 * 60 * 24 * 7
+    # 渲染版本, 修改拓展或渲染逻辑后加一, 已保存的文章渲染结果随之过期
+    RENDER_VERSION = 1
+
     @staticmethod
-    def _convert_markdown(value):
-        md = markdown.Markdown(
-            extensions=[
-                CustomTocExtension(),
-                CommonExtension(),
-                ListExtension(),
-                DelExtension(),
-                HighlightExtension(),
-                FoldExtension(),
-                ImageExtension(),
-                'markdown.extensions.extra',
-                'markdown.extensions.tables',
-                'markdown.extensions.codehilite',
-                'markdown.extensions.admonition',
-                CustomFootNoteExtension(),
-                EmojiExtension(),
-                SmartyExtension(),
-                KatexExtension(),
-                IconExtension(),
-                TableExtension(),
-                AlertExtension()
+    def _get_extensions(profile):
+        """
+        根据渲染场景返回拓展列表
+        :param profile: article - 文章, block - 文章分块, comment - 评论
+        :return: 拓展列表
+        """
+        if profile == 'comment':
+            # 评论只支持一小部分安全的语法, 不需要目录、脚注、公式等文章拓展
+            return [
+                CommentExtension(),
+                'markdown.extensions.fenced_code',
+                CachedCodeHiliteExtension()
             ]
-        )
-        body = md.convert(value)
-        toc = md.toc
+        # 文章和文章分块带目录
+        return [
+            CustomTocExtension(),
+            StyleExtension(),
+            DelExtension(),
+            HighlightExtension(),
+            ImageExtension(),
+            'markdown.extensions.extra',
+            'markdown.extensions.tables',
+            CachedCodeHiliteExtension(),
+            'markdown.extensions.admonition',
+            CustomFootNoteExtension(),
+            EmojiExtension(),
+            SmartyExtension(),
+            CachedKatexExtension(),
+            IconExtension(),
+            AlertExtension()
+        ]
+
+    @staticmethod
+    def get_render_hash(value):
+        """
+        文章渲染结果的哈希, 包含正文和渲染版本
+        :param value: markdown 正文
+        :return: 哈希
+        """
+        return get_sha256('{version}:{value}'.format(version=CommonMarkdown.RENDER_VERSION, value=value))
+
+    @staticmethod
+    def create_engine(profile='article'):
+        """
+        新建一个 markdown 引擎
+        :param profile: 渲染场景, block - 文章分块, 与文章相同但不生成脚注列表
+        :return: markdown 引擎
+        """
+        md = markdown.Markdown(extensions=CommonMarkdown._get_extensions(profile))
+        if profile == 'block':
+            # 脚注列表由全文的脚注定义单独渲染一次, 拼接在所有块之后
+            md.treeprocessors.deregister('footnote')
+        return md
+
+    @staticmethod
+    def get_engine(profile='article'):
+        """
+        获取当前线程复用的 markdown 引擎, 不存在则新建
+        :param profile: 渲染场景
+        :return: markdown 引擎
+        """
+        engines = getattr(CommonMarkdown._engines, 'engines', None)
+        if engines is None:
+            engines = CommonMarkdown._engines.engines = {}
+        md = engines.get(profile)
+        if md is None:
+            md = engines[profile] = CommonMarkdown.create_engine(profile)
+        return md
+
+    @staticmethod
+    def _convert_markdown(value, profile='article'):
+        md = CommonMarkdown.get_engine(profile)
+        try:
+            body = md.convert(value)
+            toc = getattr(md, 'toc', '')
+        finally:
+            md.reset()
         return body, toc
 
     @staticmethod
-    def get_markdown_with_all(value):
-        body, toc = CommonMarkdown._convert_markdown(value)
+    def get_markdown_with_all(value, profile='article'):
+        body, toc = CommonMarkdown._convert_markdown(value, profile)
         return body, toc
 
     @staticmethod
-    def get_markdown(value):
-        body, toc = CommonMarkdown._convert_markdown(value)
+    def get_markdown(value, profile='article'):
+        body, toc = CommonMarkdown._convert_markdown(value, profile)
         return body
 
+    @staticmethod
+    def _split_blocks(value):
+        """
+        将文章按顶层块切分: 标题段落、围栏代码块和提示块, 同时收集全文共享的链接引用、脚注和缩写定义
+        只在空行之后切分, 块内容与整篇渲染时看到的一致; 遇到无法确定边界的内容时不切分
+        :param value: markdown 正文
+        :return: (块列表, 定义文本), 无法安全切分时返回 None
+        """
+        if '[TOC]' in value or '///Footnotes Go Here///' in value:
+            # 目录和脚注标记需要看到全文
+            return None
+        blocks, current, definitions = [], [], []
+        fence = None
+        in_alert = alert_end = in_footnote = pending = False
+        prev_blank = True
+        for line in value.replace('\r\n', '\n').replace('\r', '\n').split('\n'):
+            if fence:
+                # 围栏内原样保留, 直到遇到相同的结束围栏
+                current.append(line)
+                if line.rstrip(' ') == fence:
+                    fence = None
+                    pending = not in_alert
+                alert_end = prev_blank = False
+                continue
+            if not line.strip():
+                if in_alert and alert_end:
+                    in_alert, pending = False, True
+                if in_footnote:
+                    definitions[-1].append(line)
+                current.append(line)
+                prev_blank = True
+                continue
+            if BLOCK_HTML_RE.match(line):
+                # html 块可以跨越空行, 整篇渲染
+                return None
+            indented = line[:1] in [' ', '\t']
+            if in_footnote and (indented or not prev_blank):
+                definitions[-1].append(line)
+            else:
+                in_footnote = False
+                fence_match = BLOCK_FENCE_RE.match(line)
+                alert_match = prev_blank and not in_alert and BLOCK_ALERT_RE.match(line)
+                if prev_blank and not in_alert and current and (
+                        line.startswith('#') or fence_match or alert_match or (pending and not indented)):
+                    blocks.append('\n'.join(current))
+                    current = []
+                if fence_match:
+                    fence = fence_match.group(1)
+                elif alert_match:
+                    in_alert = True
+                elif BLOCK_FOOTNOTE_RE.match(line):
+                    in_footnote = True
+                    definitions.append([line])
+                elif BLOCK_DEFINITION_RE.match(line):
+                    definitions.append([line])
+            pending = False
+            alert_end = in_alert and line.rstrip().endswith(':::')
+            current.append(line)
+            prev_blank = False
+        blocks.append('\n'.join(current))
+        blocks = [block for block in blocks if block.strip()]
+        context = '\n\n'.join('\n'.join(lines).rstrip() for lines in definitions)
+        if len(blocks) < 2 or (context and blocks[0].lstrip('\n')[:1] in [' ', '\t']):
+            # 缩进开头的首块会被当成脚注定义的后续段落
+            return None
+        return blocks, context
+
+    @staticmethod
+    def _flatten_toc_tokens(tokens):
+        flat = []
+        for token in tokens:
+            flat.append({key: value for key, value in token.items() if key != 'children'})
+            flat.extend(CommonMarkdown._flatten_toc_tokens(token['children']))
+        return flat
+
+    @staticmethod
+    def _render_block(value, profile='block'):
+        """
+        渲染单个块, 结果以内容哈希缓存
+        :param value: 块内容
+        :param profile: 渲染场景
+        :return: (html, 扁平的目录项列表)
+        """
+        # 共享缓存跨越部署, 键中带上渲染版本
+        key = 'markdown_block:{profile}:{hash}'.format(profile=profile, hash=CommonMarkdown.get_render_hash(value))
+        result = CommonMarkdown._block_cache.get(key)
+        if result is None:
+            result = cache.get(key)
+            if result is None:
+                md = CommonMarkdown.get_engine(profile)
+                try:
+                    html = md.convert(value)
+                    tokens = CommonMarkdown._flatten_toc_tokens(md.toc_tokens)
+                finally:
+                    md.reset()
+                result = (html, tokens)
+                cache.set(key, result, CommonMarkdown.block_cache_timeout)
+            CommonMarkdown._block_cache.set(key, result)
+        return result
+
+    @staticmethod
+    def _build_toc(tokens):
+        """
+        由各块的目录项拼出全文目录
+        """
+        md = CommonMarkdown.get_engine('block')
+        try:
+            div = md.treeprocessors['toc'].build_toc_div(nest_toc_tokens([dict(token) for token in tokens]))
+            toc = md.serializer(div)
+            for pp in md.postprocessors:
+                toc = pp.run(toc)
+        finally:
+            md.reset()
+        return toc
+
+    @staticmethod
+    def get_markdown_incremental(value):
+        """
+        分块增量渲染文章, 只有内容变化的块会重新渲染, 结果与整篇渲染一致
+        每个块都带上全文的定义一起渲染, 脚注列表和目录在所有块渲染完后统一拼接
+        :param value: markdown 正文
+        :return: (正文 html, 目录 html)
+        """
+        split = CommonMarkdown._split_blocks(value)
+        if split is None:
+            return CommonMarkdown.get_markdown_with_all(value)
+        blocks, context = split
+        if context and CommonMarkdown._render_block(context)[0]:
+            # 定义部分会产生输出, 说明收集的不只是定义
+            return CommonMarkdown.get_markdown_with_all(value)
+
+        katex_styles = KATEX_STYLES.lstrip()
+        parts, tokens, ids = [], [], set()
+        has_katex = False
+        prefix = context + '\n\n' if context else ''
+        jobs = [(prefix + block, 'block') for block in blocks]
+        if context:
+            # 只有定义的文本按文章渲染, 得到全文的脚注列表
+            jobs.append((context, 'article'))
+        for text, profile in jobs:
+            html, block_tokens = CommonMarkdown._render_block(text, profile)
+            block_ids = set(BLOCK_ID_RE.findall(html))
+            if ids & block_ids:
+                # 重复的标题锚点或多次引用的脚注需要全文编号
+                return CommonMarkdown.get_markdown_with_all(value)
+            ids |= block_ids
+            if html.startswith(katex_styles):
+                has_katex = True
+                html = html[len(katex_styles):]
+            if html:
+                parts.append(html)
+            tokens.extend(block_tokens)
+        body = '\n'.join(parts)
+        if has_katex:
+            body = katex_styles + body
+        return body, CommonMarkdown._build_toc(tokens)
+
 
 def send_email(subject: str, message: str, recipient_list: list):
     """
@@ -6,14 +6,24 @@
 # @Software: PyCharm
 import re
 import xml.etree.ElementTree as etree
+from hashlib import sha256
+from html import unescape
+from urllib.parse import urlparse
 from xml.etree.ElementTree import Element
 
 from markdown.blockprocessors import BlockProcessor
 from markdown.extensions import Extension
+from markdown.extensions import codehilite, fenced_code
+from markdown.extensions.codehilite import CodeHilite, CodeHiliteExtension
 from markdown.extensions.footnotes import FootnoteExtension, FN_BACKLINK_TEXT, NBSP_PLACEHOLDER
 from markdown.extensions.toc import TocTreeprocessor, TocExtension
 from markdown.inlinepatterns import InlineProcessor
 from markdown.treeprocessors import Treeprocessor
+from markdown.util import AMP_SUBSTITUTE
+from markdown_katex.extension import (KatexExtension, KatexPreprocessor, KatexPostprocessor, make_marker_id,
+                                      md_block2html, md_inline2html)
+
+from utils.cache import LRUCache, cache
 
 
 class TocProcessor(TocTreeprocessor):
@@ -54,8 +64,17 @@ class TocProcessor(TocTreeprocessor):
         if 'prettify' in self.md.treeprocessors:
             self.md.treeprocessors['prettify'].run(div)
 
+        self.toc_div = div
         return div
 
+    def run(self, doc: etree.Element) -> None:
+        self.toc_div = None
+        super().run(doc)
+        # [TOC] 标记插入正文的目录在目录序列化之后使用正文的列表样式
+        if self.marker and self.toc_div is not None:
+            for ul in self.toc_div.iter('ul'):
+                ul.attrib['class'] = StyleProcessor.ul_class
+
 
 class CustomTocExtension(TocExtension):
     TreeProcessorClass = TocProcessor
@@ -66,9 +85,13 @@ class CustomTocExtension(TocExtension):
         super().__init__(**kwargs)
 
 
-class CommonProcessor(Treeprocessor):
-    """遍历根节点并修改任何发现的标签"""
+class StyleProcessor(Treeprocessor):
+    """
+    样式处理器, 一次遍历完成通用标签样式、列表(含任务列表)、表格包裹和折叠块转换
+    注册在 prettify 之后运行, 新建的块级元素需要自行补上换行
+    """
 
+    # 通用标签样式, 追加到已有样式之后
     classes = {
         "h1": "scroll-m-20 text-4xl mt-8 mb-4 font-extrabold tracking-tight dark:text-neutral-200",
         "h2": "scroll-m-20 border-b pb-2 text-3xl mt-6 mb-3 font-semibold tracking-tight first:mt-0 dark:text-neutral-200",
@@ -82,51 +105,88 @@ class CommonProcessor(Treeprocessor):
         "a": "text-primary decoration-2 font-medium hover:underline"
     }
 
-    def run(self, root):
-        for node in root.iter():
-            tag_classes = self.classes.get(node.tag)
-            if tag_classes:
-                if node.get('class'):
-                    node.attrib["class"] = node.attrib['class'] + " " + tag_classes
-                else:
-                    node.attrib['class'] = tag_classes
-
-
-class CommonExtension(Extension):
-    """一个用于向标签添加类的扩展"""
+    # 表格标签样式, 覆盖已有样式
+    table_classes = {
+        "table": "w-full",
+        "tr": "m-0 border-t p-0 even:bg-muted",
+        "td": "border px-4 py-2 text-left [&[align=center]]:text-center [&[align=right]]:text-right dark:text-neutral-200",
+        "th": "border px-4 py-2 text-left font-bold [&[align=center]]:text-center [&[align=right]]:text-right dark:text-neutral-200"
+    }
+    table_wrapper_class = "my-6 w-full overflow-y-auto"
 
-    def extendMarkdown(self, md):
-        md.treeprocessors.register(
-            CommonProcessor(md), "common", 20)
+    ul_class = "my-6 ml-6 list-disc list-outside [&>li]:mt-2 dark:text-neutral-200"
+    task_ul_class = "my-6 list-disc list-outside [&>li]:mt-2 dark:text-neutral-200"
+    ol_class = "my-6 ml-6 list-decimal list-outside [&>li]:mt-2 dark:text-neutral-200"
+    ol_item_class = "mt-0 pl-2 text-sm text-gray-800 dark:text-neutral-200"
 
+    fold_class = "group border-b"
+    fold_summary_class = "px-4 py-2 cursor-pointer text-lg font-medium text-gray-800 bg-gray-100 group-open:bg-gray-200"
+    fold_content_class = "px-4 py-2"
 
-class ListProcessor(Treeprocessor):
     def run(self, root):
-        # Iterate through all elements
-        for element in root.iter():
-            if element.tag == 'ul':
-                element.attrib['class'] = "my-6 ml-6 list-disc list-outside [&>li]:mt-2 dark:text-neutral-200"
-                # Check if this is a task list
-                self.process_unordered_list(element)
-            elif element.tag == 'ol':
-                element.attrib['class'] = "my-6 ml-6 list-decimal list-outside [&>li]:mt-2 dark:text-neutral-200"
-                self.process_ordered_list(element)
+        self.process(root)
+
+    def process(self, parent):
+        # 替换子元素时保持下标不变, 因此可以直接按下标赋值
+        for index, child in enumerate(list(parent)):
+            if child.tag == 'p' and child.text and child.text.startswith('details:'):
+                parent[index] = self.create_fold(child)
+                continue
+            tag_classes = self.classes.get(child.tag)
+            if tag_classes:
+                if child.get('class'):
+                    child.attrib['class'] = child.attrib['class'] + " " + tag_classes
+                else:
+                    child.attrib['class'] = tag_classes
+            tag_classes = self.table_classes.get(child.tag)
+            if tag_classes:
+                child.attrib['class'] = tag_classes
+            if child.tag == 'table':
+                parent[index] = self.wrap_table(child)
+            elif child.tag == 'ul':
+                self.process_unordered_list(child)
+            elif child.tag == 'ol':
+                self.process_ordered_list(child)
+            self.process(child)
+
+    def wrap_table(self, table):
+        # 创建一个div元素并设置类名, 将table元素包裹在div中
+        div = Element('div')
+        div.attrib['class'] = self.table_wrapper_class
+        div.text = '\n'
+        div.tail = table.tail
+        div.append(table)
+        return div
+
+    def create_fold(self, p):
+        text_list = p.text.split('\n')
+        details = etree.Element('details', {'class': self.fold_class})
+        summary = etree.SubElement(details, 'summary', {'class': self.fold_summary_class})
+        div = etree.SubElement(details, 'div', {'class': self.fold_content_class})
+        summary.text = text_list[0].strip('details:').strip()
+        for p_text in text_list[1:]:
+            child = etree.SubElement(div, 'p', {'class': self.classes['p']})
+            child.text = p_text
+            child.tail = '\n'
+        details.text = summary.tail = div.tail = '\n'
+        if len(div):
+            div.text = '\n'
+        details.tail = p.tail
+        return details
 
     def process_unordered_list(self, ul):
+        ul.attrib['class'] = self.ul_class
         for li in ul.findall('li'):
             # Check for task list item
             if li.text and li.text.strip().startswith('[ ]'):
-                ul.attrib['style'] = "padding-inline-start: 0px;"
-                ul.attrib['class'] = "my-6 list-disc list-outside [&>li]:mt-2 dark:text-neutral-200"
-                li.attrib['style'] = "list-style-type: none;"
-                self.create_task_list_item(li, 'unchecked')
+                self.create_task_list_item(ul, li, 'unchecked')
             elif li.text and li.text.strip().startswith('[x]'):
-                ul.attrib['style'] = "padding-inline-start: 0px;"
-                ul.attrib['class'] = "my-6 list-disc list-outside [&>li]:mt-2 dark:text-neutral-200"
-                li.attrib['style'] = "list-style-type: none;"
-                self.create_task_list_item(li, 'checked')
+                self.create_task_list_item(ul, li, 'checked')
 
-    def create_task_list_item(self, li, status):
+    def create_task_list_item(self, ul, li, status):
+        ul.attrib['style'] = "padding-inline-start: 0px;"
+        ul.attrib['class'] = self.task_ul_class
+        li.attrib['style'] = "list-style-type: none;"
         # Create a checkbox for task list items
         checkbox = Element('input', type='checkbox', disabled='true')
         if status == 'checked':
@@ -140,20 +200,22 @@ class ListProcessor(Treeprocessor):
         li.text = ""
 
     def process_ordered_list(self, ol):
+        ol.attrib['class'] = self.ol_class
         for li in ol.findall('li'):
             text = li.text
             li.text = ''
             span = etree.SubElement(li, 'span')
             span.text = text
-            span.set('class', 'mt-0 pl-2 text-sm text-gray-800 dark:text-neutral-200')
+            span.set('class', self.ol_item_class)
 
 
-class ListExtension(Extension):
+class StyleExtension(Extension):
     """
-    列表渲染拓展
+    样式拓展, 为标签添加样式并渲染列表、表格和折叠块
     """
     def extendMarkdown(self, md):
-        md.treeprocessors.register(ListProcessor(md), 'list', 5)
+        # 位于 prettify(10) 之后、attr_list(8) 之前
+        md.treeprocessors.register(StyleProcessor(md), "style", 9)
 
 
 class DelInlineProcessor(InlineProcessor):
@@ -189,31 +251,6 @@ class HighlightExtension(Extension):
         md.inlinePatterns.register(HighlightInlineProcessor(HIGH_LIGHT_PATTERN, md), 'highlight', 15)
 
 
-class FoldProcessor(Treeprocessor):
-    def run(self, root):
-        for child in root.iter('p'):
-            if child.text and child.text.startswith('details:'):
-                text_list = child.text.split('\n')
-                details = etree.Element('details', {'class': 'group border-b'})
-                summary = etree.Element('summary', {'class': 'px-4 py-2 cursor-pointer text-lg font-medium text-gray-800 bg-gray-100 group-open:bg-gray-200'})
-                div = etree.Element('div', {'class': 'px-4 py-2'})
-                summary.text = text_list[0].strip('details:').strip()
-                for p_text in text_list[1:]:
-                    p = etree.Element('p', {'class': 'leading-normal [&:not(:first-child)]:mt-6 text-base font-normal text-black dark:text-neutral-200'})
-                    p.text = p_text
-                    div.append(p)
-                details.append(summary)
-                details.append(div)
-                p_index = list(root).index(child)
-                root.remove(child)
-                root.insert(p_index, details)
-
-
-class FoldExtension(Extension):
-    def extendMarkdown(self, md):
-        md.treeprocessors.register(FoldProcessor(md), "fold", 20)
-
-
 class ImageProcessor(InlineProcessor):
     def handleMatch(self, m, data):
         figure = etree.Element('figure')
@@ -263,36 +300,6 @@ class IconExtension(Extension):
         md.inlinePatterns.register(IconInlineProcessor(ICON_PATTERN, md), 'icon', 180)
 
 
-class TableProcessor(Treeprocessor):
-    def run(self, root):
-        for table in root.iter('table'):
-            trs = table.iter('tr')
-            for tr in trs:
-                tr.attrib['class'] = "m-0 border-t p-0 even:bg-muted"
-            tds = table.iter('td')
-            for td in tds:
-                td.attrib[
-                    'class'] = "border px-4 py-2 text-left [&[align=center]]:text-center [&[align=right]]:text-right dark:text-neutral-200"
-            ths = table.iter('th')
-            for th in ths:
-                th.attrib[
-                    'class'] = "border px-4 py-2 text-left font-bold [&[align=center]]:text-center [&[align=right]]:text-right dark:text-neutral-200"
-            table.attrib['class'] = "w-full"
-            # 创建一个div元素并设置类名
-            div = Element('div')
-            div.attrib['class'] = "my-6 w-full overflow-y-auto"
-            # 将table元素包裹在div中
-            el_index = list(root).index(table)
-            root.remove(table)
-            div.append(table)
-            root.insert(el_index, div)
-
-
-class TableExtension(Extension):
-    def extendMarkdown(self, md):
-        md.treeprocessors.register(TableProcessor(md), "table", 185)
-
-
 class AlertBlockProcessor(BlockProcessor):
     RE_FENCE_START = r'^:{3}\s*primary\s*.*\n*|^:{3}\s*secondary\s*.*\n*|^:{3}\s*success\s*.*\n*|^:{3}\s*error\s*.*\n*|^:{3}\s*warning\s*.*\n*|^:{3}\s*info\s*.*\n*'
     RE_FENCE_END = r'\n*:{3}$'
@@ -373,6 +380,11 @@ class CustomFootNoteExtension(FootnoteExtension):
     """
     自定义脚注
     """
+    def extendMarkdown(self, md):
+        super().extendMarkdown(md)
+        # 返回链接带有自定义样式类, 重复引用的返回链接从未生成过, 保持现有输出
+        md.treeprocessors.deregister('footnote-duplicate')
+
     def makeFootnotesDiv(self, root: etree.Element) -> etree.Element | None:
         """ Return `div` of footnotes as `etree` Element. """
 
@@ -416,3 +428,151 @@ class CustomFootNoteExtension(FootnoteExtension):
                     p = etree.SubElement(li, "p")
                     p.append(backlink)
         return div
+
+
+class CachedCodeHilite(CodeHilite):
+    """
+    带缓存的代码高亮, 以 (语言, 代码哈希, 格式化选项) 为键
+    进程内 LRU 在前, Django 缓存在后, 同一段代码在文章和评论之间只交给 Pygments 高亮一次
+    """
+    local_cache = LRUCache(maxsize=1024)
+    cache_timeout = 60 * 60 * 24 * 7
+
+    def get_cache_key(self, shebang):
+        code_hash = sha256(self.src.encode('utf-8')).hexdigest()
+        options = sorted((key, repr(value)) for key, value in self.options.items())
+        unique_str = repr((self.lang, code_hash, shebang, self.guess_lang, self.use_pygments,
+                           self.lang_prefix, self.pygments_formatter, options))
+        return 'code_hilite:' + sha256(unique_str.encode('utf-8')).hexdigest()
+
+    def hilite(self, shebang=True):
+        key = self.get_cache_key(shebang)
+        code = self.local_cache.get(key)
+        if code is None:
+            code = cache.get(key)
+            if code is None:
+                code = super().hilite(shebang)
+                cache.set(key, code, self.cache_timeout)
+            self.local_cache.set(key, code)
+        return code
+
+
+class CachedCodeHiliteExtension(CodeHiliteExtension):
+    """
+    带缓存的代码高亮拓展, 同时接管缩进代码块和围栏代码块的高亮
+    上游的 HiliteTreeprocessor 和 FencedBlockPreprocessor 在 run 中按模块里的 CodeHilite 名称实例化高亮类,
+    加载拓展时把这两个名称换成 CachedCodeHilite, 处理器本身沿用上游实现; 高亮结果与原类一致, 其他引擎不受影响
+    """
+    def extendMarkdown(self, md):
+        codehilite.CodeHilite = CachedCodeHilite
+        fenced_code.CodeHilite = CachedCodeHilite
+        super().extendMarkdown(md)
+
+
+katex_local_cache = LRUCache(maxsize=2048)
+
+
+def cached_tex2html(render, tex, options):
+    """
+    带缓存的 KaTeX 渲染, 以 (公式类型, 公式哈希, 选项) 为键
+    进程内 LRU 在前, Django 缓存在后, 命中时无需再启动 katex 进程
+    :param render: md_block2html 或 md_inline2html
+    :param tex: 公式
+    :param options: katex 选项
+    :return: 渲染后的 html
+    """
+    options = options or {}
+    tex_hash = sha256(tex.encode('utf-8')).hexdigest()
+    unique_str = repr((render.__name__, tex_hash, sorted((key, repr(value)) for key, value in options.items())))
+    key = 'katex:' + sha256(unique_str.encode('utf-8')).hexdigest()
+    html = katex_local_cache.get(key)
+    if html is None:
+        html = cache.get(key)
+        if html is None:
+            html = render(tex, options)
+            cache.set(key, html, CachedCodeHilite.cache_timeout)
+        katex_local_cache.set(key, html)
+    return html
+
+
+class CachedKatexPreprocessor(KatexPreprocessor):
+    def _make_tag_for_block(self, block_lines):
+        indent_len = len(block_lines[0]) - len(block_lines[0].lstrip())
+        indent_text = block_lines[0][:indent_len]
+        block_text = '\n'.join(line[indent_len:] for line in block_lines).rstrip()
+        marker_id = make_marker_id('block' + block_text)
+        marker_tag = 'tmp_block_md_katex_{0}'.format(marker_id)
+        math_html = cached_tex2html(md_block2html, block_text, self.ext.options)
+        self.ext.math_html[marker_tag] = '<p>{0}</p>'.format(math_html)
+        return indent_text + marker_tag
+
+    def _make_tag_for_inline(self, inline_text):
+        marker_id = make_marker_id('inline' + inline_text)
+        marker_tag = 'tmp_inline_md_katex_{0}'.format(marker_id)
+        math_html = cached_tex2html(md_inline2html, inline_text, self.ext.options)
+        self.ext.math_html[marker_tag] = math_html
+        return marker_tag
+
+
+class CachedKatexExtension(KatexExtension):
+    """
+    带缓存的 KaTeX 拓展, 公式在服务端渲染为 html, 页面无需再加载 KaTeX 脚本
+    """
+    def extendMarkdown(self, md):
+        md.preprocessors.register(CachedKatexPreprocessor(md, self), name='katex_fenced_code_block', priority=50)
+        md.postprocessors.register(KatexPostprocessor(md, self), name='katex_fenced_code_block', priority=0)
+        md.registerExtension(self)
+
+
+class SafeLinkProcessor(Treeprocessor):
+    """
+    只保留 http、https、mailto 和站内相对链接, 去掉 javascript: 等其他协议的链接地址
+    先解码实体并去掉空白和控制字符, 与浏览器解析链接的方式一致, 协议无法解析时同样去掉
+    """
+    allowed_schemes = ['', 'http', 'https', 'mailto']
+    ignored_chars_re = re.compile(r'[\x00-\x20\x7f-\x9f]+')
+
+    def is_safe(self, href):
+        href = unescape(href.replace(AMP_SUBSTITUTE, '&'))
+        try:
+            scheme = urlparse(self.ignored_chars_re.sub('', href)).scheme
+        except ValueError:
+            return False
+        return scheme.lower() in self.allowed_schemes
+
+    def run(self, root):
+        for a in root.iter('a'):
+            if 'href' in a.attrib and not self.is_safe(a.get('href')):
+                del a.attrib['href']
+
+
+class CommentStyleProcessor(StyleProcessor):
+    """
+    评论样式处理器, 只添加通用标签样式, 不转换折叠块
+    """
+
+    def process(self, parent):
+        for child in parent:
+            tag_classes = self.classes.get(child.tag)
+            if tag_classes:
+                child.attrib['class'] = (child.get('class', '') + ' ' + tag_classes).strip()
+            self.process(child)
+
+
+class CommentExtension(Extension):
+    """
+    评论拓展, 只保留段落、强调、链接、行内代码和围栏代码, 原始 html 按文本转义, 不支持折叠块
+    """
+    preprocessors = ['html_block']
+    block_processors = ['indent', 'code', 'hashheader', 'setextheader', 'hr', 'olist', 'ulist', 'quote']
+    inline_patterns = ['image_link', 'image_reference', 'short_image_ref', 'html']
+
+    def extendMarkdown(self, md):
+        for name in self.preprocessors:
+            md.preprocessors.deregister(name)
+        for name in self.block_processors:
+            md.parser.blockprocessors.deregister(name)
+        for name in self.inline_patterns:
+            md.inlinePatterns.deregister(name)
+        md.treeprocessors.register(CommentStyleProcessor(md), 'style', 9)
+        md.treeprocessors.register(SafeLinkProcessor(md), 'safe_link', 1)